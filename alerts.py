@@ -0,0 +1,401 @@
+#!/opt/ioa/software/python/2.7.8/bin/python
+
+""" Rate-limited alerts and a circuit breaker for FITSCHECKER failures. """
+
+from __future__ import absolute_import, print_function, with_statement
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import logging
+import os
+import textwrap
+import threading
+import time
+from datetime import datetime
+
+import checker
+
+
+# Failures that are worth alerting the GES administrators about.
+ALERTED_FAILURES = checker.INFRASTRUCTURE_FAILURES + (checker.MISSING_LOG, )
+
+# The number of example files to keep for each failure signature.
+MAX_EXAMPLES = 3
+
+
+def failure_signature(release, result):
+    """
+    Return the signature that a FITSCHECKER failure is grouped by: the release,
+    the kind of failure and, for crashes, the exception type or signal.
+
+    :param release:
+        The name of the data release.
+
+    :type release:
+        str
+
+    :param result:
+        The outcome of running FITSCHECKER.
+
+    :type result:
+        :class:`checker.CheckResult`
+    """
+
+    signature = "{0}: {1}".format(release, result.status)
+    if result.error is not None:
+        signature += " ({0})".format(result.error)
+    return signature
+
+
+def _format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")
+
+
+
+class AlertAggregator(object):
+    """
+    Collect FITSCHECKER failures and send the GES administrators one alert for
+    all of them, instead of one email per folder on every retry.
+
+    Failures are grouped by signature (see :func:`failure_signature`). When
+    :func:`flush` is called, every signature that has not been alerted on in
+    the last `window` seconds is sent in a single email, with the number of
+    failures and the folders affected since its last alert. Signatures alerted
+    on more recently keep counting until their window has passed.
+
+    :param mailer:
+        A function with the same signature as :func:`run.email_report`.
+
+    :param recipients:
+        The people to alert.
+
+    :type recipients:
+        list of str
+
+    :param window: [optional]
+        The minimum time (in seconds) between alerts for the same signature.
+
+    :type window:
+        float
+
+    :param state: [optional]
+        The state of a previous aggregator (see `state`), so that alerts are
+        rate-limited across separate runs of the watcher.
+
+    :type state:
+        dict
+    """
+
+    def __init__(self, mailer, recipients, window=6 * 3600, state=None):
+
+        self.mailer = mailer
+        self.recipients = recipients
+        self.window = window
+        self.state = state if state is not None else {}
+        self._lock = threading.Lock()
+
+
+    def record(self, release, folder, result):
+        """
+        Record a FITSCHECKER failure.
+
+        :param release:
+            The name of the data release.
+
+        :type release:
+            str
+
+        :param folder:
+            The watched folder, with a `path` and a list of `owners`.
+
+        :type folder:
+            dict
+
+        :param result:
+            The outcome of running FITSCHECKER.
+
+        :type result:
+            :class:`checker.CheckResult`
+        """
+
+        if result.status not in ALERTED_FAILURES:
+            return
+
+        now = time.time()
+        signature = failure_signature(release, result)
+        with self._lock:
+            group = self.state.setdefault(signature, {
+                "count": 0, "folders": [], "examples": [],
+                "first_seen": now, "last_alert": None,
+            })
+            if group["count"] == 0:
+                group["first_seen"] = now
+            group["count"] += 1
+            group["last_seen"] = now
+            if folder["path"] not in group["folders"]:
+                group["folders"].append(folder["path"])
+            if len(group["examples"]) < MAX_EXAMPLES:
+                group["examples"].append([result.filename, result.message,
+                    result.log_filename])
+
+        logging.warn("Recorded FITSCHECKER failure {0} for {1}: {2}".format(
+            signature, result.filename, result.message))
+
+
+    def flush(self, notes=None, force=False):
+        """
+        Send one alert for every failure signature that is due.
+
+        :param notes: [optional]
+            Extra paragraphs to add to the alert (e.g., paused releases).
+
+        :type notes:
+            list of str
+
+        :param force: [optional]
+            Send the alert with the notes even if no signature is due (e.g.,
+            because dispatch has just been paused). Every signature with
+            failures since its last alert is included.
+
+        :type force:
+            bool
+
+        :returns:
+            The signatures that were alerted on.
+        """
+
+        now = time.time()
+        with self._lock:
+
+            # Forget signatures that have been quiet for a whole window, so
+            # that the next failure is alerted on straight away.
+            for signature in list(self.state.keys()):
+                group = self.state[signature]
+                if group["count"] == 0 and group["last_alert"] is not None \
+                and now - group["last_alert"] >= self.window:
+                    del self.state[signature]
+
+            due = sorted([signature for signature, group in self.state.items() \
+                if group["count"] > 0 and (force \
+                    or group["last_alert"] is None \
+                    or now - group["last_alert"] >= self.window)])
+            suppressed = sorted([signature \
+                for signature, group in self.state.items() \
+                if group["count"] > 0 and signature not in due])
+
+            for signature in suppressed:
+                logging.info("Not alerting on {0} ({1} failure(s)) until {2}"\
+                    .format(signature, self.state[signature]["count"],
+                        _format_time(self.state[signature]["last_alert"] \
+                            + self.window)))
+
+            if not due and not (force and notes):
+                return []
+
+            paragraphs, attachments = [], []
+            for signature in due:
+                group = self.state[signature]
+                lines = ["{0}: {1} failure(s) in {2} folder(s) between {3} and "
+                    "{4}".format(signature, group["count"],
+                        len(group["folders"]), _format_time(group["first_seen"]),
+                        _format_time(group["last_seen"]))]
+                lines.append("    Folders:")
+                lines.extend(["        {0}".format(path) \
+                    for path in group["folders"]])
+                lines.append("    For example:")
+                for filename, message, log_filename in group["examples"]:
+                    lines.append("        {0}: {1}".format(filename, message))
+                    if log_filename is not None and os.path.exists(log_filename)\
+                    and log_filename not in attachments:
+                        attachments.append(log_filename)
+                paragraphs.append("\n".join(lines))
+
+                group.update(count=0, folders=[], examples=[], last_alert=now)
+
+        contents = textwrap.dedent("""\
+            Dear kind overlords,
+
+            I think something has gone wrong with FITSCHECKER:
+
+            {0}
+
+            I have not sent any emails to the owners of folders where FITSCHECKER timed out, crashed, or wrote a short log, and I have not updated the inventory for them, so those files will be checked again later. I will not tell you about the same problem again for another {1:.0f} hour(s).
+
+            Best wishes,
+            Robot.
+            """).format("\n\n".join(paragraphs + list(notes or [])),
+                self.window / 3600.)
+
+        if due:
+            subject = "FITSCHECKER failures: {0}".format(", ".join(due))
+        else:
+            subject = "FITSCHECKER dispatch paused"
+        self.mailer(self.recipients, contents, subject=subject,
+            attachments=attachments or None)
+        return due
+
+
+
+class CircuitBreaker(object):
+    """
+    Pause FITSCHECKER dispatch for a release after repeated infrastructure
+    failures, and resume it once a health probe passes.
+
+    After `threshold` consecutive failures the breaker opens and :func:`allow`
+    returns False. Any further failure while it is open (e.g., from jobs that
+    were already queued) starts the cooldown again. Once `cooldown` seconds
+    have passed, the next call to :func:`allow` runs the probe: if it passes,
+    the breaker closes; if not, the cooldown starts again. Without a probe, one
+    check is let through as a trial and its result decides instead. The trial
+    is part of the state, so a later run of the watcher will not let another
+    one through while it is still outstanding. Only a run that finishes with a
+    complete log (`checker.OK`) resets the count or closes the breaker.
+
+    :param name:
+        The name of the release the breaker is for.
+
+    :type name:
+        str
+
+    :param threshold: [optional]
+        The number of consecutive infrastructure failures that opens the
+        breaker.
+
+    :type threshold:
+        int
+
+    :param cooldown: [optional]
+        The time (in seconds) to wait before probing an open breaker.
+
+    :type cooldown:
+        float
+
+    :param probe: [optional]
+        A function that returns True if FITSCHECKER is healthy.
+
+    :param state: [optional]
+        The state of a previous breaker (see `state`), so that a pause lasts
+        across separate runs of the watcher.
+
+    :type state:
+        dict
+    """
+
+    def __init__(self, name, threshold=3, cooldown=3600, probe=None,
+        state=None):
+
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.probe = probe
+        self.state = state if state is not None else {}
+        self.state.setdefault("failures", 0)
+        self.state.setdefault("opened", None)
+        self.state.setdefault("trial", None)
+        self._lock = threading.Lock()
+
+
+    @property
+    def paused(self):
+        """ Whether dispatch is currently paused. """
+        return self.state["opened"] is not None
+
+
+    def describe(self):
+        """
+        Return a sentence describing a paused breaker, or None if it is closed.
+        """
+
+        if not self.paused:
+            return None
+        return "FITSCHECKER dispatch for {0} has been paused since {1} after "\
+            "{2} consecutive failure(s). I will check whether it is healthy "\
+            "again after {3}.".format(self.name,
+                _format_time(self.state["opened"]), self.state["failures"],
+                _format_time(self.state["opened"] + self.cooldown))
+
+
+    def _open(self, now):
+        self.state.update(opened=now, trial=None)
+        logging.warn("Pausing FITSCHECKER dispatch for {0} after {1} "
+            "consecutive failure(s)".format(self.name, self.state["failures"]))
+
+
+    def _close(self):
+        self.state.update(failures=0, opened=None, trial=None)
+        logging.info("Resuming FITSCHECKER dispatch for {0}".format(self.name))
+
+
+    def allow(self):
+        """
+        Return whether FITSCHECKER should be run now.
+        """
+
+        with self._lock:
+            now = time.time()
+            if self.state["opened"] is None:
+                return True
+            if now - self.state["opened"] < self.cooldown \
+            or (self.state["trial"] is not None \
+                and now - self.state["trial"] < self.cooldown):
+                return False
+            self.state["trial"] = now
+
+        if self.probe is None:
+            logging.info("Letting one FITSCHECKER run through for {0} as a "
+                "trial".format(self.name))
+            return True
+
+        logging.info("Probing FITSCHECKER health for {0}".format(self.name))
+        try:
+            healthy = self.probe()
+        except Exception:
+            logging.exception("Exception in FITSCHECKER health probe for {0}"\
+                .format(self.name))
+            healthy = False
+
+        with self._lock:
+            if healthy:
+                self._close()
+            else:
+                logging.warn("FITSCHECKER health probe failed for {0}".format(
+                    self.name))
+                self._open(time.time())
+            return healthy
+
+
+    def record(self, result):
+        """
+        Record the outcome of running FITSCHECKER.
+
+        :param result:
+            The outcome of running FITSCHECKER.
+
+        :type result:
+            :class:`checker.CheckResult`
+        """
+
+        with self._lock:
+            if result.infrastructure_failure:
+                self.state["failures"] += 1
+                if self.state["opened"] is not None \
+                or self.state["failures"] >= self.threshold:
+                    self._open(time.time())
+
+            elif result.status == checker.MISSING_FILE:
+                # FITSCHECKER never ran, so this tells us nothing and another
+                # trial can be let through.
+                self.state["trial"] = None
+
+            elif result.status != checker.OK:
+                # FITSCHECKER ran but did not show that it is healthy (e.g., it
+                # exited without writing a log), so leave the breaker as it is.
+                pass
+
+            elif self.state["opened"] is None:
+                self.state["failures"] = 0
+
+            elif self.state["trial"] is not None:
+                # The trial run (which may have been queued by an earlier run
+                # of the watcher) has passed.
+                self._close()
@@ -26,6 +26,8 @@ from email import Encoders
 from getpass import getuser
 from glob import glob
 
+import status
+
 
 INVENTORY_FILENAME = "/data/arc/codes/ges-watcher/inventory.yaml"
 
@@ -42,26 +44,7 @@ def check_node_submission(list_of_submitted_files):
         list
     """
 
-    results = {}
-    any_ok = False
-
-    for filename, created, updated in list_of_submitted_files:
-
-        log_filename = filename[:-5] + "_FITSchecker_REPORT.log"
-        with open(log_filename, "r") as fp:
-            log_contents = fp.read()
-            num_invalids = len(re.findall("INVALID", log_contents))
-            num_lines = log_contents.count("\n")
-
-        results[filename] = (num_invalids, num_lines)
-
-        if any_ok is False and num_lines >= 30 and num_invalids == 0:
-            return (True, filename)
-
-    if len(list_of_submitted_files) > 0:
-        return (False, results)
-
-    return (None, None)
+    return status.classify(status.published_results(list_of_submitted_files))
 
 
 if __name__ == "__main__":
@@ -81,7 +64,7 @@ if __name__ == "__main__":
     folders = sorted(inventory.keys())
     for folder in folders:
         wg, node = folder.split("/")[-2:]
-        if node in ("Recommended", "PerSpectra"): continue
+        if node in status.IGNORED_NODES: continue
 
         submitted_contents = inventory[folder]
         result, info = check_node_submission(submitted_contents)
@@ -107,7 +90,11 @@ if __name__ == "__main__":
     print("Nodes that have submitted results, but they still have errors:")
     for _ in k:
         print("\t{0}:".format(_))
-        for filename, (num_invalids, num_lines) in submitted_and_invalid[_].items():
+        for filename, log_results in submitted_and_invalid[_].items():
+            if log_results is None:
+                print("\t\t{0}: not checked yet".format(filename))
+                continue
+            num_invalids, num_lines = log_results
             print("\t\t{0}: {1} INVALIDs, {2} lines".format(filename, num_invalids,
                 num_lines))
         print("\n")
@@ -0,0 +1,418 @@
+#!/opt/ioa/software/python/2.7.8/bin/python
+
+""" Run FITSCHECKER on a single file in a resource-limited worker process. """
+
+from __future__ import absolute_import, print_function, with_statement
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import argparse
+import errno
+import logging
+import os
+import re
+import resource
+import select
+import signal
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+
+# Outcomes of a FITSCHECKER run.
+OK = "ok"
+TIMEOUT = "timeout"
+CRASH = "crash"
+SHORT_LOG = "short log"
+MISSING_LOG = "missing log"
+MISSING_FILE = "missing file"
+
+# Outcomes that point to a problem with FITSCHECKER itself (or the host it runs
+# on) rather than with the submitted file. These should be retried later.
+INFRASTRUCTURE_FAILURES = (TIMEOUT, CRASH, SHORT_LOG)
+
+# [TODO] What is the critical number?
+MINIMUM_LOG_LINES = 30
+
+# FITSCHECKER is started through this module (see `exec_limited`), so that the
+# resource limits are applied after the fork without running Python code in a
+# child of a multi-threaded process.
+WRAPPER = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+
+
+def exec_limited(executable, cpu_limit=None, memory_limit=None):
+    """
+    Start a new session, apply resource limits, and replace the current process
+    with FITSCHECKER. This does not return.
+
+    :param executable:
+        The path of the FITSCHECKER script to execute.
+
+    :type executable:
+        str
+
+    :param cpu_limit: [optional]
+        The CPU time (in seconds) allowed.
+
+    :type cpu_limit:
+        int
+
+    :param memory_limit: [optional]
+        The maximum address space (in bytes).
+
+    :type memory_limit:
+        int
+    """
+
+    # Start a new session so that a timeout can kill the whole process group,
+    # including anything the FITSCHECKER script spawns.
+    os.setsid()
+
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    if cpu_limit is not None:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit))
+    if memory_limit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    try:
+        os.execv(executable, [executable])
+    except OSError as e:
+        print("Could not execute {0}: {1}".format(executable, e),
+            file=sys.stderr)
+        os._exit(127)
+
+
+def parse_log(contents):
+    """
+    Count the number of INVALID entries and lines in a FITSCHECKER log.
+
+    :param contents:
+        The contents of a FITSCHECKER log file.
+
+    :type contents:
+        str
+
+    :returns:
+        A two-length tuple containing the number of INVALID entries and the
+        number of lines in the log.
+    """
+    return (len(re.findall("INVALID", contents)), contents.count("\n"))
+
+
+class CheckResult(object):
+    """
+    The outcome of running FITSCHECKER on a single file.
+    """
+
+    def __init__(self, filename, status, log_filename=None, return_code=None,
+        num_invalids=0, num_lines=0, output="", output_truncated=0,
+        duration=0, message=None, error=None):
+
+        self.filename = filename
+        self.status = status
+        self.log_filename = log_filename
+        self.return_code = return_code
+        self.num_invalids = num_invalids
+        self.num_lines = num_lines
+        self.output = output
+        self.output_truncated = output_truncated
+        self.duration = duration
+        self.message = message
+        self.error = error
+
+
+    @property
+    def infrastructure_failure(self):
+        """ Whether this failure should be retried rather than reported. """
+        return self.status in INFRASTRUCTURE_FAILURES
+
+
+    def __repr__(self):
+        return "<CheckResult {0}: {1}>".format(self.filename, self.status)
+
+
+
+class FITSChecker(object):
+    """
+    A worker that runs the FITSCHECKER script on one file at a time, without a
+    shell, with a wall-clock timeout, CPU and memory limits, and a bounded
+    capture of the script output.
+
+    :param executable:
+        The path of the FITSCHECKER script to execute.
+
+    :type executable:
+        str
+
+    :param log_format:
+        A format string for the path of the log written by FITSCHECKER, which
+        is given the `basename` of the checked file and the current `date`.
+
+    :type log_format:
+        str
+
+    :param timeout: [optional]
+        The wall-clock time (in seconds) allowed for a single run.
+
+    :type timeout:
+        float
+
+    :param cpu_limit: [optional]
+        The CPU time (in seconds) allowed for a single run.
+
+    :type cpu_limit:
+        int
+
+    :param memory_limit: [optional]
+        The maximum address space (in bytes) of a single run.
+
+    :type memory_limit:
+        int
+
+    :param max_output: [optional]
+        The maximum number of bytes of output to keep from a single run. Any
+        further output is read and discarded.
+
+    :type max_output:
+        int
+
+    :param minimum_log_lines: [optional]
+        The minimum number of lines expected in a complete FITSCHECKER log.
+
+    :type minimum_log_lines:
+        int
+    """
+
+    def __init__(self, executable, log_format, timeout=900, cpu_limit=600,
+        memory_limit=4 * 1024**3, max_output=64 * 1024,
+        minimum_log_lines=MINIMUM_LOG_LINES):
+
+        self.executable = executable
+        self.log_format = log_format
+        self.timeout = timeout
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
+        self.max_output = max_output
+        self.minimum_log_lines = minimum_log_lines
+
+
+    def log_filename(self, filename):
+        """
+        Return the path of the log that FITSCHECKER will write for a file.
+
+        :param filename:
+            The path of the FITS file to check.
+
+        :type filename:
+            str
+        """
+        return self.log_format.format(
+            basename=os.path.splitext(os.path.basename(filename))[0],
+            date=datetime.now().strftime("%Y-%m-%d"))
+
+
+    def command(self):
+        """
+        Return the command that runs FITSCHECKER with the resource limits
+        applied (see :func:`exec_limited`).
+        """
+
+        command = [sys.executable, WRAPPER]
+        if self.cpu_limit is not None:
+            command.extend(["--cpu-limit", str(self.cpu_limit)])
+        if self.memory_limit is not None:
+            command.extend(["--memory-limit", str(self.memory_limit)])
+        return command + ["--", self.executable]
+
+
+    def _kill(self, process):
+        """
+        Terminate the process group of a FITSCHECKER run, and kill it if it
+        does not exit promptly.
+        """
+
+        for sig, grace in ((signal.SIGTERM, 5), (signal.SIGKILL, None)):
+            try:
+                os.killpg(process.pid, sig)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+                # The wrapper may not have started its own session yet.
+                if process.poll() is not None:
+                    break
+                process.send_signal(sig)
+
+            if grace is None:
+                break
+
+            deadline = time.time() + grace
+            while time.time() < deadline and process.poll() is None:
+                time.sleep(0.1)
+            if process.poll() is not None:
+                break
+
+        process.wait()
+
+
+    def run(self, filename):
+        """
+        Run FITSCHECKER on a single file.
+
+        :param filename:
+            The path of the FITS file to check.
+
+        :type filename:
+            str
+
+        :returns:
+            A :class:`CheckResult` describing the outcome.
+        """
+
+        if not os.path.exists(filename):
+            logging.warn("Filename {} found but no longer exists. We will "
+                "skip it now and it will be removed in the next inventory "
+                "update".format(filename))
+            return CheckResult(filename, MISSING_FILE,
+                message="File no longer exists")
+
+        log_filename = self.log_filename(filename)
+        if os.path.exists(log_filename):
+            logging.warn("FITSCHECKER log filename {} already exists!"\
+                .format(log_filename))
+
+        logging.info("Running FITSCHECKER on {0}".format(filename))
+        t_init = time.time()
+        try:
+            process = subprocess.Popen(self.command(),
+                cwd=os.path.dirname(self.executable),
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                env={
+                    "filepath": filename,
+                },
+                close_fds=True)
+
+        except Exception as e:
+            logging.exception("Exception in running FITSCHECKER on {0}"\
+                .format(filename))
+            return CheckResult(filename, CRASH, log_filename=log_filename,
+                duration=time.time() - t_init, message=str(e),
+                error=type(e).__name__)
+
+        # Stream the output so that a chatty FITSCHECKER cannot fill memory.
+        output, truncated, timed_out = [], 0, False
+        kept, fd = 0, process.stdout.fileno()
+        deadline = t_init + self.timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                timed_out = True
+                break
+
+            try:
+                readable, _, _ = select.select([fd], [], [], remaining)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if not readable:
+                continue
+
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                break
+
+            if kept < self.max_output:
+                chunk, overflow = chunk[:self.max_output - kept], \
+                    chunk[self.max_output - kept:]
+                output.append(chunk)
+                kept += len(chunk)
+                truncated += len(overflow)
+            else:
+                truncated += len(chunk)
+
+        # FITSCHECKER may close its output and carry on, so the deadline still
+        # applies after the end of the output.
+        while not timed_out and process.poll() is None:
+            if time.time() >= deadline:
+                timed_out = True
+                break
+            time.sleep(min(0.1, max(0, deadline - time.time())))
+
+        if timed_out:
+            self._kill(process)
+        process.stdout.close()
+
+        result = CheckResult(filename, None, log_filename=log_filename,
+            return_code=process.returncode, output="".join(output),
+            output_truncated=truncated, duration=time.time() - t_init)
+
+        logging.info("FITSCHECKER finished on {0} with return code {1} after "
+            "{2:.1f} seconds and output{3}:\n{4}".format(filename,
+                result.return_code, result.duration,
+                " ({} bytes truncated)".format(truncated) if truncated else "",
+                result.output))
+
+        if timed_out:
+            result.status = TIMEOUT
+            result.message = "FITSCHECKER did not finish within {0} seconds"\
+                .format(self.timeout)
+
+        elif process.returncode < 0:
+            # Killed by a signal, which includes exceeding the CPU limit.
+            result.status = CRASH
+            result.message = "FITSCHECKER was killed by signal {0}".format(
+                -process.returncode)
+            result.error = "signal {0}".format(-process.returncode)
+
+        else:
+            log_exists = os.path.exists(log_filename)
+            if log_exists:
+                with open(log_filename, "r") as fp:
+                    result.num_invalids, result.num_lines = parse_log(fp.read())
+
+            complete = log_exists \
+                and result.num_lines >= self.minimum_log_lines
+
+            if process.returncode != 0 and not complete:
+                # FITSCHECKER failed without writing a complete log (e.g., the
+                # interpreter could not be found), so it did not check the file.
+                result.status = CRASH
+                result.message = "FITSCHECKER exited with status {0}".format(
+                    process.returncode)
+                result.error = "exit status {0}".format(process.returncode)
+
+            elif not log_exists:
+                result.status = MISSING_LOG
+                result.message = "Could not find FITSCHECKER log file {0}"\
+                    .format(log_filename)
+
+            elif not complete:
+                result.status = SHORT_LOG
+                result.message = "FITSCHECKER log at {0} has only {1} lines"\
+                    .format(log_filename, result.num_lines)
+            else:
+                result.status = OK
+
+        if result.status != OK:
+            logging.warn("FITSCHECKER {0} on {1}: {2}".format(result.status,
+                filename, result.message))
+
+        return result
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Run FITSCHECKER in a new "
+        "session with resource limits. This is used by FITSChecker.run.")
+    parser.add_argument("--cpu-limit", type=int, default=None,
+        help="The CPU time (in seconds) allowed.")
+    parser.add_argument("--memory-limit", type=int, default=None,
+        help="The maximum address space (in bytes).")
+    parser.add_argument("executable",
+        help="The path of the FITSCHECKER script to execute.")
+    args = parser.parse_args()
+
+    exec_limited(args.executable, cpu_limit=args.cpu_limit,
+        memory_limit=args.memory_limit)
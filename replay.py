@@ -0,0 +1,421 @@
+#!/opt/ioa/software/python/2.7.8/bin/python
+
+""" Replay recorded inventories through the watcher to measure throughput. """
+
+from __future__ import absolute_import, division, print_function, with_statement
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import yaml
+from datetime import datetime
+
+import checker
+import run
+
+
+class StubChecker(object):
+    """
+    A stand-in for :class:`checker.FITSChecker` that never runs FITSCHECKER or
+    reads the checked file. It writes a fake FITSCHECKER log to a scratch
+    directory instead.
+
+    :param scratch:
+        The directory to write fake FITSCHECKER logs to.
+
+    :type scratch:
+        str
+
+    :param delay: [optional]
+        The time (in seconds) that each check should take.
+
+    :type delay:
+        float
+
+    :param invalid_fraction: [optional]
+        The fraction of files that should be reported with INVALID entries.
+
+    :type invalid_fraction:
+        float
+
+    :param failure_fraction: [optional]
+        The fraction of checks that should fail with a short log.
+
+    :type failure_fraction:
+        float
+
+    :param seed: [optional]
+        The seed for the random number generator.
+
+    :type seed:
+        int
+    """
+
+    def __init__(self, scratch, delay=0, invalid_fraction=0.1,
+        failure_fraction=0, seed=None):
+
+        self.scratch = scratch
+        self.delay = delay
+        self.invalid_fraction = invalid_fraction
+        self.failure_fraction = failure_fraction
+        self.random = random.Random(seed)
+
+
+    def run(self, filename):
+        """
+        Pretend to run FITSCHECKER on a single file.
+
+        :param filename:
+            The path of the FITS file to check.
+
+        :type filename:
+            str
+
+        :returns:
+            A :class:`checker.CheckResult` describing the outcome.
+        """
+
+        t_init = time.time()
+        if self.delay > 0:
+            time.sleep(self.delay)
+
+        log_filename = os.path.join(self.scratch,
+            "{0}_FITSchecker_REPORT_{1}.log".format(
+                os.path.splitext(os.path.basename(filename))[0],
+                datetime.now().strftime("%Y-%m-%d")))
+
+        if self.random.random() < self.failure_fraction:
+            lines = ["Something went wrong"]
+        else:
+            lines = ["Checked keyword {0}: OK".format(i) for i in range(40)]
+            if self.random.random() < self.invalid_fraction:
+                lines[-1] = "Checked keyword 39: INVALID"
+
+        contents = "\n".join(lines) + "\n"
+        with open(log_filename, "w") as fp:
+            fp.write(contents)
+
+        num_invalids, num_lines = checker.parse_log(contents)
+        status = checker.SHORT_LOG if num_lines < checker.MINIMUM_LOG_LINES \
+            else checker.OK
+        return checker.CheckResult(filename, status, log_filename=log_filename,
+            return_code=0, num_invalids=num_invalids, num_lines=num_lines,
+            duration=time.time() - t_init, message="Replayed check")
+
+
+
+class ReplayMailer(object):
+    """
+    Records the emails that the watcher would have sent, instead of sending
+    them.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+
+    def send(self, recipients, contents, subject="Automated FITS-checker report",
+        attachments=None):
+        """
+        Record an email. This has the same signature as :func:`run.email_report`.
+        """
+        self.messages.append((recipients, subject, contents, attachments))
+        return (0, "This is a replay -- no emails actually sent.")
+
+
+
+def percentile(values, q):
+    """
+    Return the q-th percentile of some values, using the nearest rank.
+
+    :param values:
+        The values.
+
+    :type values:
+        list
+
+    :param q:
+        The percentile to return, between 0 and 100.
+
+    :type q:
+        float
+    """
+
+    if not values:
+        return float("nan")
+
+    values = sorted(values)
+    index = int(round(q / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def inventory_events(previous_inventory, current_inventory):
+    """
+    Return the new and modified files between two recorded inventories as a
+    list of `(folder, entry)` events.
+
+    :param previous_inventory:
+        The earlier recorded inventory.
+
+    :type previous_inventory:
+        dict
+
+    :param current_inventory:
+        The later recorded inventory.
+
+    :type current_inventory:
+        dict
+    """
+
+    events = []
+    for path, current in current_inventory.items():
+        previous = previous_inventory.get(path, [])
+        for entry in run.new_file_inventory(previous, current) \
+        + run.modified_file_inventory(previous, current):
+            events.append((path, tuple(entry)))
+    return events
+
+
+def load_events(filename):
+    """
+    Load a recorded event log. The event log is a YAML list of mappings, each
+    with a `folder`, and the `path`, `created` and `modified` times of a file.
+
+    :param filename:
+        The path of the event log.
+
+    :type filename:
+        str
+    """
+
+    with open(filename, "r") as fp:
+        records = yaml.load(fp) or []
+
+    return [(record["folder"],
+        (record["path"], record["created"], record["modified"])) \
+        for record in records]
+
+
+def update_inventory(inventory, entries):
+    """
+    Return a copy of a folder inventory with some entries added or replaced.
+
+    :param inventory:
+        The inventory of a folder.
+
+    :type inventory:
+        list
+
+    :param entries:
+        The `(path, created, modified)` entries to add or replace.
+
+    :type entries:
+        list
+    """
+
+    updated = dict([(each[0].lower(), each) for each in inventory])
+    updated.update(dict([(each[0].lower(), each) for each in entries]))
+    return sorted(updated.values())
+
+
+def replay(previous_inventory, events, fitschecker, mailer, speed_up=3600,
+    interval=3600, max_retries=24):
+    """
+    Replay recorded events through the watcher, polling the replayed inventory
+    at a fixed interval of recorded time.
+
+    :param previous_inventory:
+        The inventory at the start of the replay.
+
+    :type previous_inventory:
+        dict
+
+    :param events:
+        The recorded `(folder, entry)` events, where each entry is a
+        `(path, created, modified)` tuple.
+
+    :type events:
+        list
+
+    :param fitschecker:
+        The worker used to check each file.
+
+    :param mailer:
+        A function with the same signature as :func:`run.email_report`.
+
+    :param speed_up: [optional]
+        The factor by which to speed up recorded time.
+
+    :type speed_up:
+        float
+
+    :param interval: [optional]
+        The recorded time (in seconds) between each poll of the inventory.
+
+    :type interval:
+        float
+
+    :param max_retries: [optional]
+        The number of polls to keep retrying failed folders after the last
+        event has arrived.
+
+    :type max_retries:
+        int
+
+    :returns:
+        A dictionary of replay statistics.
+    """
+
+    owners = dict([(folder["path"], folder["owners"]) \
+        for release in run.RELEASES for folder in release["folders"]])
+
+    inventory = dict(previous_inventory)
+    events = sorted(events, key=lambda event: max(event[1][1:]))
+    if not events:
+        return dict(n_events=0, n_checks=0, n_polls=0, n_unreported=0,
+            wall_time=0, busy_time=0, latencies=[], lags=[])
+
+    t_first = max(events[0][1][1:])
+    t_last = max(events[-1][1][1:])
+    n_polls = int((t_last - t_first) // interval) + 1 + max_retries
+
+    pending, latencies, lags = {}, [], []
+    n_checks, busy_time, index = 0, 0, 0
+    wall_init = time.time()
+    for poll in range(1, n_polls + 1):
+
+        t_poll = t_first + poll * interval
+        if index >= len(events) and not pending:
+            break
+
+        # Wait until this poll is due in replayed time.
+        wall_poll = wall_init + (t_poll - t_first) / speed_up
+        wait = wall_poll - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        else:
+            lags.append(-wait)
+
+        # Events are pending from the moment they arrive in replayed time.
+        while index < len(events) and max(events[index][1][1:]) <= t_poll:
+            folder, entry = events[index]
+            wall_arrival = wall_init + (max(entry[1:]) - t_first) / speed_up
+            pending.setdefault(folder, []).append((entry, wall_arrival))
+            index += 1
+
+        for path in sorted(pending.keys()):
+            folder = {
+                "path": path,
+                "owners": owners.get(path,
+                    ["Owner of {0} <owner@example.org>".format(path)])
+            }
+            previous = inventory.get(path, [])
+            current = update_inventory(previous,
+                [entry for entry, _ in pending[path]])
+
+            t_init = time.time()
+            inventory[path], results = run.check_folder(folder, previous,
+                current, fitschecker, mailer=mailer,
+                publish=lambda filename, log_filename: None)
+            t_done = time.time()
+
+            busy_time += t_done - t_init
+            n_checks += len(results)
+
+            if inventory[path] is current:
+                latencies.extend([t_done - wall_arrival \
+                    for _, wall_arrival in pending.pop(path)])
+
+    return dict(n_events=len(events), n_checks=n_checks, n_polls=poll,
+        n_unreported=sum(map(len, pending.values())),
+        wall_time=time.time() - wall_init, busy_time=busy_time,
+        latencies=latencies, lags=lags)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Replay recorded inventories "
+        "or events through the watcher, without sending any email, and report "
+        "the throughput and latency.")
+    parser.add_argument("inventories", nargs="*",
+        help="The previous and current recorded inventory files.")
+    parser.add_argument("--events",
+        help="A recorded event log to replay instead of a current inventory.")
+    parser.add_argument("--previous",
+        help="The inventory at the start of the event log.")
+    parser.add_argument("--speed-up", type=float, default=3600,
+        help="The factor by which to speed up recorded time.")
+    parser.add_argument("--interval", type=float, default=3600,
+        help="The recorded time (in seconds) between polls.")
+    parser.add_argument("--max-retries", type=int, default=24,
+        help="The number of extra polls allowed for failed folders.")
+    parser.add_argument("--check-time", type=float, default=0,
+        help="The time (in seconds) each stub check should take.")
+    parser.add_argument("--invalid-fraction", type=float, default=0.1,
+        help="The fraction of stub checks that report INVALID entries.")
+    parser.add_argument("--failure-fraction", type=float, default=0,
+        help="The fraction of stub checks that fail with a short log.")
+    parser.add_argument("--seed", type=int, default=None,
+        help="The seed for the stub checker.")
+    parser.add_argument("--scratch", default=None,
+        help="The scratch directory for logs (default: a new temporary one).")
+    args = parser.parse_args()
+
+    if args.events is not None:
+        if args.inventories:
+            parser.error("give either two inventories or --events, not both")
+        previous_inventory = run.load_inventory(args.previous) \
+            if args.previous is not None else {}
+        events = load_events(args.events)
+
+    elif len(args.inventories) == 2:
+        previous_inventory = run.load_inventory(args.inventories[0])
+        events = inventory_events(previous_inventory,
+            run.load_inventory(args.inventories[1]))
+
+    else:
+        parser.error("give a previous and current inventory, or --events")
+
+    scratch = args.scratch or tempfile.mkdtemp(prefix="ges-watcher-replay-")
+    if not os.path.exists(scratch):
+        os.makedirs(scratch)
+
+    # Nothing in a replay should ever reach SMTP.
+    run.SEND_EMAILS = False
+    logging.basicConfig(level=logging.DEBUG,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        filename=os.path.join(scratch, "replay.log"))
+
+    mailer = ReplayMailer()
+    fitschecker = StubChecker(scratch, delay=args.check_time,
+        invalid_fraction=args.invalid_fraction,
+        failure_fraction=args.failure_fraction, seed=args.seed)
+
+    stats = replay(previous_inventory, events, fitschecker, mailer.send,
+        speed_up=args.speed_up, interval=args.interval,
+        max_retries=args.max_retries)
+
+    latencies = stats["latencies"]
+    print("Replayed {0} event(s) over {1} poll(s) in {2:.2f} seconds".format(
+        stats["n_events"], stats["n_polls"], stats["wall_time"]))
+    print("Ran {0} check(s) and recorded {1} email(s); {2} event(s) were never "
+        "reported".format(stats["n_checks"], len(mailer.messages),
+            stats["n_unreported"]))
+    print("Throughput: {0:.2f} checks/s overall, {1:.2f} checks/s while busy"\
+        .format(stats["n_checks"] / max(stats["wall_time"], 1e-9),
+            stats["n_checks"] / max(stats["busy_time"], 1e-9)))
+    print("Latency from arrival to report (seconds of wall time):")
+    for q in (50, 90, 99, 100):
+        print("\tp{0}: {1:.3f} ({2:.0f} s recorded)".format(q,
+            percentile(latencies, q), percentile(latencies, q) * args.speed_up))
+    if stats["lags"]:
+        print("The watcher fell behind the replay schedule on {0} poll(s), by "
+            "up to {1:.3f} seconds".format(len(stats["lags"]),
+                max(stats["lags"])))
+    print("Logs are in {0}".format(scratch))
@@ -6,6 +6,7 @@ from __future__ import absolute_import, print_function, with_statement
 
 __author__ = "Andy Casey <arc@ast.cam.ac.uk>"
 
+import argparse
 import fnmatch
 import logging
 import os
@@ -26,11 +27,21 @@ from email import Encoders
 from getpass import getuser
 from glob import glob
 
+import alerts
+import checker
+import scheduler
+import status
+import workqueue
 
-SEND_EMAILS = False
+
+SEND_EMAILS = True
 FITSCHECKER = "/data/gaia-eso/geswg15/GESIoA/iDR4PA/WG15/FITSChecker/run_fitschecker.sh"
 FITSCHECKER_LOG_FORMAT = "/data/gaia-eso/geswg15/GESIoA/iDR4PA/WG15/FITSChecker"\
     "/Output/{basename}_FITSchecker_REPORT_{date}.log"
+FITSCHECKER_TIMEOUT = 15 * 60
+FITSCHECKER_CPU_LIMIT = 10 * 60
+FITSCHECKER_MEMORY_LIMIT = 4 * 1024**3
+FITSCHECKER_MAX_OUTPUT = 64 * 1024
 GES_ADMINISTRATORS = [
     "Andy Casey <arc@ast.cam.ac.uk>",
     "Clare Worley <ccworley@ast.cam.ac.uk>"
@@ -275,9 +286,51 @@ FOLDERS_TO_WATCH = [
 ]
 
 
-logging.basicConfig(level=logging.DEBUG, 
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    filename=os.path.join(os.path.dirname(__file__), "iDR4.log"))
+LOG_FILENAME = os.path.join(os.path.dirname(__file__), "iDR4.log")
+
+# The number of FITSCHECKER runs to have going at once, shared between all of
+# the releases below.
+FITSCHECKER_WORKERS = 1
+
+# FITSCHECKER failures are grouped into one alert per ALERT_WINDOW seconds, and
+# dispatch for a release is paused for CIRCUIT_BREAKER_COOLDOWN seconds after
+# CIRCUIT_BREAKER_THRESHOLD consecutive failures. The state of both is kept in
+# ALERT_STATE_FILENAME between runs.
+ALERT_STATE_FILENAME = os.path.join(os.path.dirname(__file__), "alerts.yaml")
+ALERT_WINDOW = 6 * 3600
+CIRCUIT_BREAKER_THRESHOLD = 3
+CIRCUIT_BREAKER_COOLDOWN = 3600
+
+# Each data release being watched has its own FITSCHECKER installation, folders,
+# inventory and log. Folders that are shared (or nested) between releases are
+# only crawled once. To watch another release, add another entry here.
+RELEASES = [
+    {
+        "name": "iDR4",
+        "fitschecker": FITSCHECKER,
+        "fitschecker_log_format": FITSCHECKER_LOG_FORMAT,
+        "inventory_filename": INVENTORY_FILENAME,
+        "log_filename": LOG_FILENAME,
+        "folders": FOLDERS_TO_WATCH,
+        # A known-good FITS file used to check that FITSCHECKER is healthy
+        # again after dispatch has been paused. If None, one real file (or,
+        # with a work queue, one folder) is checked as a trial instead.
+        "probe_filename": None,
+    },
+]
+
+
+class ReleaseLogFilter(logging.Filter):
+    """
+    Only pass log records from threads working for a given release, or from
+    threads that are not working for any particular release.
+    """
+
+    def filter(self, record):
+        release = scheduler.current_tenant()
+        return release is None or release == self.name
+
+
 
 def create_inventory(folder, filter_by="*.fits"):
     """
@@ -318,6 +371,100 @@ def create_inventory(folder, filter_by="*.fits"):
 
 
 
+def load_inventory(filename):
+    """
+    Load an inventory file.
+
+    :param filename:
+        The path of the inventory file.
+
+    :type filename:
+        str
+
+    :returns:
+        A dictionary of folder inventories, keyed by the folder path.
+    """
+
+    with open(filename, "r") as fp:
+        full_inventory = yaml.load(fp)
+    return full_inventory or {}
+
+
+def save_inventory(filename, full_inventory):
+    """
+    Save an inventory file.
+
+    :param filename:
+        The path of the inventory file.
+
+    :type filename:
+        str
+
+    :param full_inventory:
+        A dictionary of folder inventories, keyed by the folder path.
+
+    :type full_inventory:
+        dict
+    """
+
+    n_folders = len(full_inventory)
+    n_files = sum([len(v) for v in full_inventory.values()])
+
+    # Write to a temporary file first, so that stopping the watcher part way
+    # through never leaves a truncated inventory.
+    with open(filename + ".tmp", "w") as fp:
+        yaml.dump(full_inventory, fp)
+    os.rename(filename + ".tmp", filename)
+
+    logging.info("Saved inventory with {0} file(s) in {1} folder(s) to {2}."
+        .format(n_files, n_folders, filename))
+
+
+def shared_inventories(folders, filter_by="*.fits"):
+    """
+    Create inventories for many folders, crawling each part of the filesystem
+    only once when folders are repeated or nested inside one another.
+
+    :param folders:
+        The paths of the folders to stock take.
+
+    :type folders:
+        list of str
+
+    :param filter_by: [optional]
+        A filename filter to use for the inventory.
+
+    :type filter_by:
+        str
+
+    :returns:
+        A dictionary of folder inventories, keyed by the folder path.
+    """
+
+    folders = sorted(set([folder.rstrip("/") for folder in folders]))
+
+    roots = []
+    for folder in folders:
+        if not any([folder == root or folder.startswith(root + "/") \
+            for root in roots]):
+            roots.append(folder)
+
+    logging.info("Crawling {0} root(s) for {1} watched folder(s)".format(
+        len(roots), len(folders)))
+
+    inventories = {}
+    for root in roots:
+        inventory = create_inventory(root, filter_by=filter_by)
+        for folder in folders:
+            if folder == root:
+                inventories[folder] = inventory
+            elif folder.startswith(root + "/"):
+                inventories[folder] = [each for each in inventory \
+                    if each[0].startswith(folder + "/")]
+
+    return inventories
+
+
 def new_file_inventory(previous_inventory, current_inventory):
     """
     Returns files that have been added between two inventories.
@@ -415,7 +562,7 @@ def email_report(recipients, contents, subject="Automated FITS-checker report",
     logging.debug("Sending the following email to {0}:\n{1}\n"
         "With attachments {2}".format(recipients, contents, attachments))
 
-    if SEND_EMAILS:
+    if not SEND_EMAILS:
         return (0, "This is a *dry run* -- no emails actually sent.")
 
     to = recipients + GES_ADMINISTRATORS
@@ -444,230 +591,780 @@ def email_report(recipients, contents, subject="Automated FITS-checker report",
     return (code, message)
 
 
-if __name__ == "__main__":
+def publish_log(filename, log_filename):
+    """
+    Make a FITSCHECKER log readable by the consortium and copy it next to the
+    file that was checked.
 
-    # Usage: python run.py
+    :param filename:
+        The path of the FITS file that was checked.
 
-    # Create an initial inventory if none exists.
-    if not os.path.exists(INVENTORY_FILENAME):
-        logging.info("No previous inventory file found at {}. Creating one and "
-            "exiting the program.".format(INVENTORY_FILENAME))
+    :type filename:
+        str
 
-        full_inventory = {}
-        for folder in FOLDERS_TO_WATCH:
-            full_inventory[folder["path"]] = create_inventory(folder["path"])
+    :param log_filename:
+        The path of the FITSCHECKER log for that file.
 
-        n_folders = len(full_inventory)
-        n_files = sum([len(v) for v in full_inventory.itervalues()])
+    :type log_filename:
+        str
+    """
 
-        with open(INVENTORY_FILENAME, "w") as fp:
-            yaml.dump(full_inventory, fp)
+    logging.info("Changing group ownership to geswg15 for {}"\
+        .format(log_filename))
+    os.system("chown arc:geswg15 {}".format(log_filename))
 
-        logging.info("Saved inventory with {0} file(s) in {1} folder(s) to {2}."
-            .format(n_files, n_folders, INVENTORY_FILENAME))
-        sys.exit(0)
+    # Copy this log file to the correct path
+    most_recent_log_filename = os.path.join(os.path.dirname(filename),
+        "_".join(os.path.basename(log_filename).split("_")[:-1]) + ".log")
+    try:
+        shutil.copy(log_filename, most_recent_log_filename)
+    except IOError:
+        logging.exception("Failed to copy {0} to {1}".format(
+            log_filename, most_recent_log_filename))
 
-    # Load the previous inventory
-    with open(INVENTORY_FILENAME, "r") as fp:
-        full_inventory = yaml.load(fp)
-        if full_inventory is None:
-            full_inventory = {}
-    logging.info("Loaded inventory from {0}".format(INVENTORY_FILENAME))
+    else:
+        logging.info("Copied {0} to {1}".format(
+            log_filename, most_recent_log_filename))
 
-    # Check for updates in all folders.
-    total_updated_files, num_invalids = 0, 0
-    for folder in FOLDERS_TO_WATCH:
 
-        path = folder["path"]
+def owner_report(folder, new_files, modified_files, num_invalids):
+    """
+    Compose the email sent to the owners of a folder after their new and
+    modified files have been checked.
 
-        if path not in full_inventory:
-            logging.warn("A new folder has been added and no inventory exists:"\
-                " {0} -- you should have constructed a totally new inventory!"
-                .format(path))
-            full_inventory[path] = []
+    :param folder:
+        The watched folder, with a `path` and a list of `owners`.
 
-        current_inventory = create_inventory(path)
-        new_files = new_file_inventory(full_inventory[path], current_inventory)
+    :type folder:
+        dict
 
-        modified_files = modified_file_inventory(full_inventory[path],
-            current_inventory)
+    :param new_files:
+        The new files in the folder.
 
-        # Append to some message logger
-        if len(new_files) * len(modified_files) > 0:
-            logging.info("Found {0} new FITS file(s) and {1} modified file(s) "
-                "in {2}".format(len(new_files), len(modified_files), path))
-
-        # Run the script(s) on the new/modified files and grab the output.
-        all_updated_files = new_files + modified_files
-        total_updated_files += len(all_updated_files)
-        fitschecker_log_filenames = []
-        fitschecker_error_occurred = False
-        for filename, created, modified in all_updated_files:
-
-            if fitschecker_error_occurred:
-                logging.debug("Skipping filename {0} because a FITSCHECKER error"
-                    " occurred".format(filename))
-                continue
+    :type new_files:
+        list
 
-            if not os.path.exists(filename):
-                logging.warn("Filename {} found but no longer exists. We will "
-                    "skip it now and it will be removed in the next inventory "
-                    "update".format(filename))
-                continue
+    :param modified_files:
+        The modified files in the folder.
 
-            # Check if a log file already exists?
-            fitschecker_log_filename = FITSCHECKER_LOG_FORMAT.format(
-                basename=os.path.splitext(os.path.basename(filename))[0],
-                date=datetime.now().strftime("%Y-%m-%d"))
-            if os.path.exists(fitschecker_log_filename):
-                logging.warn("FITSCHECKER log filename {} already exists!"\
-                    .format(fitschecker_log_filename))
-
-            logging.info("Running FITSCHECKER on {0}".format(filename))
-            try:
-                #result = os.system(FITSCHECKER)
-                result = subprocess.Popen(FITSCHECKER,
-                    cwd=os.path.dirname(FITSCHECKER),
-                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                    env={
-                        "filepath": filename,
-                    },
-                    shell=True, close_fds=True)
-
-            except Exception as e:
-                logging.exception("Exception in running FITSCHECKER on {0}"\
-                    .format(filename))
-
-                # Yo, email andy!
-                return_code, return_message = email_report(["arc@ast.cam.ac.uk"],
-                    "Yo, something went wrong with FITSCHECKER: {}".format(e),
-                    subject="Error in FITSCHECKER")
+    :type modified_files:
+        list
 
-            else:
-                logging.info("FITSCHECKER finished on {0} with output:\n{1}"\
-                    .format(filename, result.stdout.read()))
-                
-                
-                if os.path.exists(fitschecker_log_filename):
-                    logging.info("Changing group ownership to geswg15 for {}"\
-                        .format(fitschecker_log_filename))
-                    os.system("chown arc:geswg15 {}".format(fitschecker_log_filename))
-
-                    with open(fitschecker_log_filename, "r") as fp:
-                        contents = fp.read()
-                        _ = len(re.findall("INVALID", fp.read()))
-                        logging.warn("FITSCHECKER found {0} 'INVALID's in {1}"\
-                            .format(_, fitschecker_log_filename))
-                        num_invalids += _
-                        num_lines = contents.count("\n")
-
-                    # [TODO] What is the critical number?
-                    if num_lines < 30:
-                        fitschecker_error_occurred = True
-                        logging.warn("FITSCHECKER log at {0} has only {1} lines"
-                            " -- something probably went wrong!".format(
-                                fitschecker_log_filename, num_lines))
-
-                        # Email the GES administrators and say something went
-                        # wrong, then do not send this email to the owner.
-
-                        contents = textwrap.dedent("""\
-                            Dear kind overlords,
-
-                            I think something has gone wrong with FITSCHECKER, because there were only {0} lines in the report file at {1} (attached).
-
-                            I have not sent any emails out to the owner, {2}, I have skipped any remaining files in this path, and I have not updated the inventory for this path. I will try again in another hour.
-
-                            Best wishes,
-                            Robot.
-                            """.format(num_lines, fitschecker_log_filename, ", ".join(folder["owners"])))
-
-                        return_code, return_message = email_report(
-                            GES_ADMINISTRATORS, contents,
-                            attachments=[fitschecker_log_filename])
-
-                        break
-
-                    # Copy this log file to the correct path
-                    most_recent_fitschecker_log_filename = os.path.join(
-                            os.path.dirname(filename),
-                            "_".join(os.path.basename(fitschecker_log_filename).split("_")[:-1]) + ".log")
-                    try:
-                        shutil.copy(fitschecker_log_filename,
-                            most_recent_fitschecker_log_filename)
-                    except IOError:
-                        logging.exception("Failed to copy {0} to {1}".format(
-                            fitschecker_log_filename,
-                            most_recent_fitschecker_log_filename))
-
-                    else:
-                        logging.info("Copied {0} to {1}".format(
-                            fitschecker_log_filename,
-                            most_recent_fitschecker_log_filename))
-                    fitschecker_log_filenames.append(fitschecker_log_filename)
+    :param num_invalids:
+        The total number of INVALID entries reported by FITSCHECKER.
 
-                else:
-                    logging.warn("Could not find FITSCHECKER log file {0}"\
-                        .format(fitschecker_log_filename))
-
-        # Send an email if there is anything to report.
-        if len(new_files) > 0 or len(modified_files) > 0 \
-        and not fitschecker_error_occurred:
-
-            if num_invalids > 0:
-                invalid_str = ("There were {} serious errors reported by FITSCH"
-                    "ECKER for your file(s). These errors are marked with the w"
-                    "ord 'INVALID' in the attached log files, and need to be fi"
-                    "xed before your results can be used. Please examine the at"
-                    "tached files, identify and correct the errors in your FITS"
-                    " file(s), and update the version in your Dropbox.".format(
-                        num_invalids))
-            else:
-                invalid_str = "There were no errors reported by FITSCHECKER f"\
-                    "or your file(s). Thanks for following the FITS format."
+    :type num_invalids:
+        int
+    """
 
-            contents = textwrap.dedent("""\
-                Dear {5},
-                
-                I have found {0} new and {1} modified FITS file(s) in the {2} Dropbox folder, which is owned by you:
+    path = folder["path"]
+    if num_invalids > 0:
+        invalid_str = ("There were {} serious errors reported by FITSCH"
+            "ECKER for your file(s). These errors are marked with the w"
+            "ord 'INVALID' in the attached log files, and need to be fi"
+            "xed before your results can be used. Please examine the at"
+            "tached files, identify and correct the errors in your FITS"
+            " file(s), and update the version in your Dropbox.".format(
+                num_invalids))
+    else:
+        invalid_str = "There were no errors reported by FITSCHECKER f"\
+            "or your file(s). Thanks for following the FITS format."
 
-                New files:
-                    {3}
+    return textwrap.dedent("""\
+        Dear {5},
 
-                Modified files:
-                    {4}
+        I have found {0} new and {1} modified FITS file(s) in the {2} Dropbox folder, which is owned by you:
 
-                FITSCHECKER has been run on these files and the logs are attached with this email. {6}
+        New files:
+            {3}
 
-                Best wishes,
-                Andy Casey
+        Modified files:
+            {4}
+
+        FITSCHECKER has been run on these files and the logs are attached with this email. {6}
+
+        Best wishes,
+        Andy Casey
+
+        """.format(
+            len(new_files), len(modified_files),
+            path.split("/")[-1],
+            "\n            ".join([e[0][len(path)+1:] for e in new_files]),
+            "\n            ".join([e[0][len(path)+1:] for e in modified_files]),
+            ", ".join([_.split(" <")[0] for _ in folder["owners"]]),
+            invalid_str))
+
+
+def updated_files(folder, previous_inventory, current_inventory):
+    """
+    Return the files that have been added or modified in a folder between two
+    inventories.
+
+    :param folder:
+        The watched folder, with a `path` and a list of `owners`.
+
+    :type folder:
+        dict
+
+    :param previous_inventory:
+        The previous inventory of the folder.
+
+    :type previous_inventory:
+        list
+
+    :param current_inventory:
+        The most recent inventory of the folder.
+
+    :type current_inventory:
+        list
+
+    :returns:
+        A two-length tuple containing the new and the modified files.
+    """
+
+    new_files = new_file_inventory(previous_inventory, current_inventory)
+    modified_files = modified_file_inventory(previous_inventory,
+        current_inventory)
+
+    # Append to some message logger
+    if len(new_files) + len(modified_files) > 0:
+        logging.info("Found {0} new FITS file(s) and {1} modified file(s) "
+            "in {2}".format(len(new_files), len(modified_files),
+                folder["path"]))
+
+    return (new_files, modified_files)
+
+
+def report_folder(folder, previous_inventory, current_inventory, new_files,
+    modified_files, results, mailer=email_report, publish=publish_log,
+    alert=None):
+    """
+    Email the FITSCHECKER results for the new and modified files in a folder to
+    the folder owners, or to the GES administrators if FITSCHECKER failed.
+
+    :param folder:
+        The watched folder, with a `path` and a list of `owners`.
+
+    :type folder:
+        dict
+
+    :param previous_inventory:
+        The previous inventory of the folder.
+
+    :type previous_inventory:
+        list
+
+    :param current_inventory:
+        The most recent inventory of the folder.
+
+    :type current_inventory:
+        list
+
+    :param new_files:
+        The new files in the folder.
+
+    :type new_files:
+        list
+
+    :param modified_files:
+        The modified files in the folder.
+
+    :type modified_files:
+        list
+
+    :param results:
+        The :class:`checker.CheckResult` objects for the new and modified
+        files, in order.
+
+    :type results:
+        list
+
+    :param mailer: [optional]
+        A function with the same signature as :func:`email_report`.
+
+    :param publish: [optional]
+        A function with the same signature as :func:`publish_log`, called for
+        every file that FITSCHECKER produced a log for.
+
+    :param alert: [optional]
+        A function called with the folder and each FITSCHECKER failure (e.g.,
+        :func:`alerts.AlertAggregator.record`). If not given, the GES
+        administrators are emailed directly about each failed folder.
+
+    :returns:
+        The inventory to store for the folder. The previous inventory is
+        returned if FITSCHECKER failed, so that the same files are checked
+        again on the next run.
+    """
+
+    path = folder["path"]
+    num_invalids, fitschecker_log_filenames = 0, []
+    for result in results:
+
+        if result.infrastructure_failure and alert is not None:
+            alert(folder, result)
+
+        elif result.infrastructure_failure:
+            # Email the GES administrators and say something went wrong, then
+            # do not send this email to the owner.
+            contents = textwrap.dedent("""\
+                Dear kind overlords,
 
-                """.format(
-                    len(new_files), len(modified_files),
-                    path.split("/")[-1],
-                    "\n                    ".join([e[0][len(path)+1:] for e in new_files]),
-                    "\n                    ".join([e[0][len(path)+1:] for e in modified_files]),
-                    ", ".join([_.split(" <")[0] for _ in folder["owners"]]),
-                    invalid_str))
+                I think something has gone wrong with FITSCHECKER ({0}) when checking {1}: {2}.
 
-            return_code, return_message = email_report(folder["owners"], contents,
-                attachments=fitschecker_log_filenames)
+                The FITSCHECKER output was:
+                {3}
 
-            # Update the existing inventory
-            full_inventory[path] = current_inventory
+                I have not sent any emails out to the owner, {4}, I have skipped any remaining files in this path, and I have not updated the inventory for this path. I will try again in another hour.
 
-        if fitschecker_error_occurred:
+                Best wishes,
+                Robot.
+                """).format(result.status, result.filename, result.message,
+                    result.output, ", ".join(folder["owners"]))
+
+            attachments = [result.log_filename] \
+                if result.log_filename is not None \
+                and os.path.exists(result.log_filename) else None
+            mailer(GES_ADMINISTRATORS, contents, attachments=attachments)
+
+        if result.infrastructure_failure:
             logging.warn("Refusing to update inventory on {} because a FITSCHEC"
                 "KER problem was detected".format(path))
+            return previous_inventory
 
+        if result.status == checker.MISSING_LOG and alert is not None:
+            alert(folder, result)
 
-    logging.info("There were {0} files updated.".format(total_updated_files))
+        if result.status in (checker.MISSING_FILE, checker.MISSING_LOG):
+            continue
 
-    # Save the updated inventory
-    n_folders = len(full_inventory)
-    n_files = sum([len(v) for v in full_inventory.values()])
-    with open(INVENTORY_FILENAME, "w") as fp:
-        yaml.dump(full_inventory, fp)
+        logging.warn("FITSCHECKER found {0} 'INVALID's in {1}"\
+            .format(result.num_invalids, result.log_filename))
+        num_invalids += result.num_invalids
+
+        publish(result.filename, result.log_filename)
+        fitschecker_log_filenames.append(result.log_filename)
+
+    # Send an email if there is anything to report.
+    if len(new_files) > 0 or len(modified_files) > 0:
+        mailer(folder["owners"],
+            owner_report(folder, new_files, modified_files, num_invalids),
+            attachments=fitschecker_log_filenames)
+
+    return current_inventory
+
+
+def check_folder(folder, previous_inventory, current_inventory, fitschecker,
+    mailer=email_report, publish=publish_log, on_result=None, alert=None,
+    breaker=None):
+    """
+    Run FITSCHECKER on the new and modified files in a folder and email the
+    results to the folder owners.
+
+    :param folder:
+        The watched folder, with a `path` and a list of `owners`.
+
+    :type folder:
+        dict
+
+    :param previous_inventory:
+        The previous inventory of the folder.
+
+    :type previous_inventory:
+        list
+
+    :param current_inventory:
+        The most recent inventory of the folder.
+
+    :type current_inventory:
+        list
+
+    :param fitschecker:
+        The worker used to check each file (see :class:`checker.FITSChecker`).
+
+    :param mailer: [optional]
+        A function with the same signature as :func:`email_report`.
+
+    :param publish: [optional]
+        A function with the same signature as :func:`publish_log`, called for
+        every file that FITSCHECKER produced a log for.
+
+    :param on_result: [optional]
+        A function called with each :class:`checker.CheckResult` once the
+        folder has been reported. It is not called if the folder is left to be
+        checked again later.
+
+    :param alert: [optional]
+        A function called with the folder and each FITSCHECKER failure (see
+        :func:`report_folder`).
+
+    :param breaker: [optional]
+        A :class:`alerts.CircuitBreaker` that is told about every result. No
+        more files are checked while it is paused, and the folder is left to
+        be checked again later without being reported.
+
+    :returns:
+        A two-length tuple containing the inventory to store for the folder and
+        a list of :class:`checker.CheckResult` objects for the files checked.
+        The previous inventory is returned if FITSCHECKER failed, so that the
+        same files are checked again on the next run.
+    """
+
+    new_files, modified_files = updated_files(folder, previous_inventory,
+        current_inventory)
+
+    # Run the script(s) on the new/modified files, stopping at the first sign
+    # that FITSCHECKER itself is broken.
+    results = []
+    for filename, created, modified in new_files + modified_files:
+        if breaker is not None and not breaker.allow():
+            logging.warn("Not checking {0} because FITSCHECKER dispatch is "
+                "paused; it will be checked again later".format(folder["path"]))
+            return (previous_inventory, results)
+
+        results.append(fitschecker.run(filename))
+        if breaker is not None:
+            breaker.record(results[-1])
+        if results[-1].infrastructure_failure:
+            break
+
+    inventory = report_folder(folder, previous_inventory, current_inventory,
+        new_files, modified_files, results, mailer=mailer, publish=publish,
+        alert=alert)
+    if on_result is not None and inventory is current_inventory:
+        for result in results:
+            on_result(result)
+    return (inventory, results)
+
+
+def release_checker(release):
+    """
+    Return the FITSCHECKER worker for a data release.
+
+    :param release:
+        The release configuration, as per `RELEASES`.
+
+    :type release:
+        dict
+    """
+    return checker.FITSChecker(release["fitschecker"],
+        release["fitschecker_log_format"],
+        timeout=FITSCHECKER_TIMEOUT, cpu_limit=FITSCHECKER_CPU_LIMIT,
+        memory_limit=FITSCHECKER_MEMORY_LIMIT,
+        max_output=FITSCHECKER_MAX_OUTPUT)
+
+
+def queue_folder(queue, release, folder, previous_inventory,
+    current_inventory):
+    """
+    Write a job to the work queue for every new and modified file in a folder.
+
+    :param queue:
+        The shared work queue.
+
+    :type queue:
+        :class:`workqueue.WorkQueue`
+
+    :param release:
+        The release configuration, as per `RELEASES`.
+
+    :type release:
+        dict
+
+    :param folder:
+        The watched folder, with a `path` and a list of `owners`.
+
+    :type folder:
+        dict
+
+    :param previous_inventory:
+        The previous inventory of the folder.
+
+    :type previous_inventory:
+        list
+
+    :param current_inventory:
+        The most recent inventory of the folder.
+
+    :type current_inventory:
+        list
+
+    :returns:
+        The inventory to store for the folder now: the current inventory if
+        there was nothing to check, otherwise the previous inventory until the
+        queued jobs are reported.
+    """
+
+    new_files, modified_files = updated_files(folder, previous_inventory,
+        current_inventory)
+    if len(new_files) + len(modified_files) == 0:
+        return current_inventory
+
+    queue.submit(release["name"], folder["path"], previous_inventory,
+        current_inventory, [each[0] for each in new_files + modified_files])
+    return previous_inventory
+
+
+def collect_folders(queue, release, full_inventory, mailer=email_report,
+    publish=publish_log, on_result=None, alert=None, breaker=None):
+    """
+    Report every folder in a release whose queued jobs have all finished, and
+    update the inventory for those folders.
+
+    :param queue:
+        The shared work queue.
+
+    :type queue:
+        :class:`workqueue.WorkQueue`
+
+    :param release:
+        The release configuration, as per `RELEASES`.
+
+    :type release:
+        dict
+
+    :param full_inventory:
+        The inventory of the release, which is updated in place.
+
+    :type full_inventory:
+        dict
+
+    :param mailer: [optional]
+        A function with the same signature as :func:`email_report`.
+
+    :param publish: [optional]
+        A function with the same signature as :func:`publish_log`.
+
+    :param on_result: [optional]
+        A function that is given the release name and folder path, and returns
+        a function (or None) to call with each :class:`checker.CheckResult` in
+        that folder once it has been reported. It is not called for folders
+        that are left to be checked again later.
+
+    :param alert: [optional]
+        A function called with the folder and each FITSCHECKER failure (see
+        :func:`report_folder`).
+
+    :param breaker: [optional]
+        A :class:`alerts.CircuitBreaker` that is told about every result.
+
+    :returns:
+        The number of folders reported.
+    """
+
+    folders = dict([(folder["path"], folder) for folder in release["folders"]])
+
+    reported = 0
+    for batch in queue.finished_batches(release["name"]):
+
+        # Another coordinator may have reported this folder already.
+        if not queue.close(batch["id"]):
+            continue
+
+        path = batch["folder"]
+        folder = folders.get(path, { "path": path, "owners": [] })
+        previous_inventory = batch["previous_inventory"]
+        current_inventory = batch["current_inventory"]
+
+        if breaker is not None:
+            for result in batch["results"]:
+                breaker.record(result)
+
+        new_files, modified_files = updated_files(folder, previous_inventory,
+            current_inventory)
+        full_inventory[path] = report_folder(folder, previous_inventory,
+            current_inventory, new_files, modified_files, batch["results"],
+            mailer=mailer, publish=publish, alert=alert)
+        reported += 1
+
+        callback = on_result(release["name"], path) \
+            if on_result is not None else None
+        if callback is not None and full_inventory[path] is current_inventory:
+            for result in batch["results"]:
+                callback(result)
+
+    return reported
+
+
+def release_breaker(release, state=None):
+    """
+    Return the circuit breaker for a data release.
+
+    :param release:
+        The release configuration, as per `RELEASES`.
+
+    :type release:
+        dict
+
+    :param state: [optional]
+        The state of the breaker from a previous run.
+
+    :type state:
+        dict
+    """
+
+    probe = None
+    if release.get("probe_filename", None) is not None:
+        fitschecker = release_checker(release)
+        probe = lambda: fitschecker.run(release["probe_filename"]).status \
+            == checker.OK
+
+    return alerts.CircuitBreaker(release["name"],
+        threshold=CIRCUIT_BREAKER_THRESHOLD, cooldown=CIRCUIT_BREAKER_COOLDOWN,
+        probe=probe, state=state)
+
+
+def watch(releases, queue=None, wait=False, poll=30, view=None):
+    """
+    Check every folder in some data releases once, report the results, and save
+    the updated inventories.
+
+    :param releases:
+        The release configurations, as per `RELEASES`.
+
+    :type releases:
+        list
+
+    :param queue: [optional]
+        A shared work queue. If given, FITSCHECKER jobs are written to the
+        queue for workers to run, rather than being run here.
+
+    :type queue:
+        :class:`workqueue.WorkQueue`
+
+    :param wait: [optional]
+        With a queue, keep running until every queued folder has been reported.
+
+    :type wait:
+        bool
+
+    :param poll: [optional]
+        With a queue, the time (in seconds) between looks at the queue.
+
+    :type poll:
+        float
+
+    :param view: [optional]
+        A status view to update as each folder is reported.
+
+    :type view:
+        :class:`status.StatusView`
+    """
+
+    def on_result(name, path):
+        if view is None:
+            return None
+        return lambda result: view.update(name, path, result)
+
+    # Restore the alert and circuit breaker state from previous runs.
+    alert_state = {}
+    if os.path.exists(ALERT_STATE_FILENAME):
+        with open(ALERT_STATE_FILENAME, "r") as fp:
+            alert_state = yaml.load(fp) or {}
+
+    aggregator = alerts.AlertAggregator(email_report, GES_ADMINISTRATORS,
+        window=ALERT_WINDOW, state=alert_state.get("alerts", None))
+    breakers = dict([(release["name"], release_breaker(release,
+        alert_state.get("breakers", {}).get(release["name"], None))) \
+        for release in releases])
+    paused_before = set([name for name, breaker in breakers.items() \
+        if breaker.paused])
+
+    def alert(name):
+        return lambda folder, result: aggregator.record(name, folder, result)
+
+    # Crawl the folders of every release at once.
+    current_inventories = shared_inventories([folder["path"] \
+        for release in releases for folder in release["folders"]])
+
+    tasks = {}
+    full_inventories = {}
+    fair_scheduler = scheduler.FairScheduler(FITSCHECKER_WORKERS)
+    for release in releases:
+        name = release["name"]
+        inventory_filename = release["inventory_filename"]
+
+        with scheduler.tenant(name):
+
+            # Create an initial inventory if none exists.
+            if not os.path.exists(inventory_filename):
+                logging.info("No previous inventory file found at {}. Creating "
+                    "one and skipping this release.".format(inventory_filename))
+
+                save_inventory(inventory_filename, dict([(folder["path"],
+                    current_inventories[folder["path"].rstrip("/")]) \
+                    for folder in release["folders"]]))
+                continue
+
+            # Load the previous inventory
+            full_inventory = load_inventory(inventory_filename)
+            full_inventories[name] = full_inventory
+            logging.info("Loaded inventory from {0}".format(inventory_filename))
+
+            # Report any folders whose queued jobs have finished since the last
+            # run, and do not queue anything new for folders still in progress.
+            # The inventory is saved as soon as a folder has been reported, so
+            # that it is not reported again if the watcher is stopped early.
+            if queue is not None:
+                if collect_folders(queue, release, full_inventory,
+                    on_result=on_result, alert=alert(name),
+                    breaker=breakers[name]):
+                    save_inventory(inventory_filename, full_inventory)
+                open_folders = queue.open_folders(name)
+                paused = not breakers[name].allow()
+
+                # While the breaker is open, only one folder is queued as a
+                # trial (unless there is a probe, which has already run).
+                trial = not paused and breakers[name].paused
+            else:
+                fitschecker = release_checker(release)
+
+            # Check for updates in all folders.
+            for folder in release["folders"]:
+
+                path = folder["path"]
+                if path not in full_inventory:
+                    logging.warn("A new folder has been added and no inventory "
+                        "exists: {0} -- you should have constructed a totally "
+                        "new inventory!".format(path))
+                    full_inventory[path] = []
+
+                if queue is None:
+                    tasks[(name, path)] = fair_scheduler.submit(name,
+                        check_folder, folder, full_inventory[path],
+                        current_inventories[path.rstrip("/")], fitschecker,
+                        on_result=on_result(name, path), alert=alert(name),
+                        breaker=breakers[name])
+
+                elif paused:
+                    logging.warn("Not queueing {0} because FITSCHECKER "
+                        "dispatch is paused".format(path))
+
+                elif path in open_folders:
+                    logging.info("Not queueing {0} because it still has "
+                        "unfinished jobs".format(path))
+
+                else:
+                    current_inventory = current_inventories[path.rstrip("/")]
+                    full_inventory[path] = queue_folder(queue, release, folder,
+                        full_inventory[path], current_inventory)
+
+                    if trial and full_inventory[path] is not current_inventory:
+                        logging.info("Queued {0} as a trial while FITSCHECKER "
+                            "dispatch is paused".format(path))
+                        paused = True
+
+    if queue is None:
+        results = fair_scheduler.run()
+
+    while queue is not None and wait \
+    and any([queue.open_folders(name) for name in full_inventories]):
+        logging.info("Waiting for {0} queued job(s) to finish".format(
+            queue.unfinished()))
+        time.sleep(poll)
+        for release in releases:
+            if release["name"] in full_inventories:
+                with scheduler.tenant(release["name"]):
+                    if collect_folders(queue, release,
+                        full_inventories[release["name"]], on_result=on_result,
+                        alert=alert(release["name"]),
+                        breaker=breakers[release["name"]]):
+                        save_inventory(release["inventory_filename"],
+                            full_inventories[release["name"]])
+
+    for release in releases:
+        name = release["name"]
+        if name not in full_inventories:
+            continue
+
+        with scheduler.tenant(name):
+            full_inventory = full_inventories[name]
+            if queue is None:
+                total_updated_files = 0
+                for folder in release["folders"]:
+                    result, exception = results[tasks[(name, folder["path"])]]
+                    if exception is not None:
+                        logging.warn("Refusing to update inventory on {} "
+                            "because an exception occurred".format(
+                                folder["path"]))
+                        continue
+
+                    inventory, folder_results = result
+                    full_inventory[folder["path"]] = inventory
+                    total_updated_files += len(folder_results)
+
+                logging.info("There were {0} files updated.".format(
+                    total_updated_files))
+
+            # Save the updated inventory
+            save_inventory(release["inventory_filename"], full_inventory)
+
+    # Send one alert for any FITSCHECKER failures, and remember what was sent.
+    # A release that has just been paused is always alerted on straight away.
+    just_paused = [name for name, breaker in breakers.items() \
+        if breaker.paused and name not in paused_before]
+    aggregator.flush(notes=[breaker.describe() \
+        for name, breaker in sorted(breakers.items()) if breaker.paused],
+        force=len(just_paused) > 0)
+
+    with open(ALERT_STATE_FILENAME, "w") as fp:
+        yaml.dump(dict(alerts=aggregator.state, breakers=dict([(name,
+            breaker.state) for name, breaker in breakers.items()])), fp)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Watch for new GES FITS files "
+        "and check them for validity.")
+    parser.add_argument("--queue", default=None,
+        help="The path of a shared work queue. If given, FITSCHECKER jobs are "
+            "written to the queue for `worker.py` processes to run, and folders "
+            "are reported once all of their jobs have finished.")
+    parser.add_argument("--wait", action="store_true",
+        help="With --queue, keep running until every queued folder has been "
+            "reported.")
+    parser.add_argument("--poll", type=float, default=30,
+        help="With --wait, the time (in seconds) between looks at the queue.")
+    parser.add_argument("--serve", type=int, default=None, metavar="PORT",
+        help="Keep running, checking every --interval seconds, and serve the "
+            "status of all submissions over HTTP on this port.")
+    parser.add_argument("--host", default="",
+        help="With --serve, the address to listen on (default: all).")
+    parser.add_argument("--interval", type=float, default=3600,
+        help="With --serve, the time (in seconds) between checks.")
+    args = parser.parse_args()
+
+    formatter = logging.Formatter(
+        "%(asctime)s - %(levelname)s - %(message)s")
+    logging.getLogger().setLevel(logging.DEBUG)
+    for release in RELEASES:
+        handler = logging.FileHandler(release["log_filename"])
+        handler.setFormatter(formatter)
+        handler.addFilter(ReleaseLogFilter(release["name"]))
+        logging.getLogger().addHandler(handler)
+
+    queue = workqueue.WorkQueue(args.queue) if args.queue is not None else None
+
+    if args.serve is None:
+        watch(RELEASES, queue=queue, wait=args.wait, poll=args.poll)
+        sys.exit(0)
+
+    view = status.StatusView()
+    for release in RELEASES:
+        if os.path.exists(release["inventory_filename"]):
+            view.load(release["name"],
+                load_inventory(release["inventory_filename"]))
+    status.serve(view, host=args.host, port=args.serve)
+
+    while True:
+        t_init = time.time()
+
+        # Keep serving the status (and try again at the next interval) if
+        # anything goes wrong, e.g. the mail server or the work queue is down.
+        try:
+            watch(RELEASES, queue=queue, wait=args.wait, poll=args.poll,
+                view=view)
+        except Exception:
+            logging.exception("Exception in watching for new FITS files")
 
-    logging.info("Updated inventory with {0} file(s) in {1} folder(s) to {2}."
-        .format(n_files, n_folders, INVENTORY_FILENAME))
+        time.sleep(max(0, args.interval - (time.time() - t_init)))
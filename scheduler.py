@@ -0,0 +1,162 @@
+#!/opt/ioa/software/python/2.7.8/bin/python
+
+""" Share a fixed number of FITSCHECKER workers fairly between tenants. """
+
+from __future__ import absolute_import, print_function, with_statement
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+_context = threading.local()
+
+
+def current_tenant():
+    """
+    Return the name of the tenant (e.g., data release) that the current thread
+    is working for, or None if it is not working for any particular tenant.
+    """
+    return getattr(_context, "tenant", None)
+
+
+@contextmanager
+def tenant(name):
+    """
+    A context manager that marks the current thread as working for a tenant.
+
+    :param name:
+        The name of the tenant.
+
+    :type name:
+        str
+    """
+
+    previous = current_tenant()
+    _context.tenant = name
+    try:
+        yield
+    finally:
+        _context.tenant = previous
+
+
+
+class FairScheduler(object):
+    """
+    Run tasks from several tenants on a fixed number of worker threads. When a
+    worker becomes free it is given to the tenant with the fewest running
+    tasks, taking turns between tenants that are tied, so that a tenant with a
+    lot of work cannot starve the others.
+
+    :param capacity: [optional]
+        The maximum number of tasks to run at once.
+
+    :type capacity:
+        int
+    """
+
+    def __init__(self, capacity=1):
+
+        if capacity < 1:
+            raise ValueError("capacity must be at least one")
+
+        self.capacity = capacity
+        self._tasks = []
+        self._pending = {}
+        self._turns = deque()
+
+
+    def submit(self, tenant_name, function, *args, **kwargs):
+        """
+        Queue a task for a tenant.
+
+        :param tenant_name:
+            The name of the tenant the task is for.
+
+        :type tenant_name:
+            str
+
+        :param function:
+            The function to call, with any remaining arguments and keywords.
+
+        :returns:
+            The index of the task in the results returned by :func:`run`.
+        """
+
+        index = len(self._tasks)
+        self._tasks.append((tenant_name, function, args, kwargs))
+        if tenant_name not in self._pending:
+            self._pending[tenant_name] = deque()
+            self._turns.append(tenant_name)
+        self._pending[tenant_name].append(index)
+        return index
+
+
+    def _next_tenant(self, running):
+        """
+        Choose the tenant to give the next free worker to.
+        """
+
+        waiting = [name for name in self._turns if self._pending[name]]
+        if not waiting:
+            return None
+
+        fewest = min([running.get(name, 0) for name in waiting])
+        for name in list(self._turns):
+            if self._pending[name] and running.get(name, 0) == fewest:
+                # Move this tenant to the back of the line.
+                self._turns.remove(name)
+                self._turns.append(name)
+                return name
+
+
+    def run(self):
+        """
+        Run all queued tasks and wait for them to finish.
+
+        :returns:
+            A list with one `(result, exception)` tuple for every submitted
+            task, in the order they were submitted.
+        """
+
+        results = [(None, None)] * len(self._tasks)
+        running = {}
+        finished = threading.Condition()
+
+        def work(index):
+            tenant_name, function, args, kwargs = self._tasks[index]
+            with tenant(tenant_name):
+                try:
+                    result = (function(*args, **kwargs), None)
+                except Exception as e:
+                    logging.exception("Exception in task {0} for {1}".format(
+                        index, tenant_name))
+                    result = (None, e)
+
+            with finished:
+                results[index] = result
+                running[tenant_name] -= 1
+                finished.notify()
+
+        with finished:
+            while True:
+                while sum(running.values()) < self.capacity:
+                    tenant_name = self._next_tenant(running)
+                    if tenant_name is None:
+                        break
+
+                    index = self._pending[tenant_name].popleft()
+                    running[tenant_name] = running.get(tenant_name, 0) + 1
+                    thread = threading.Thread(target=work, args=(index, ))
+                    thread.daemon = True
+                    thread.start()
+
+                if sum(running.values()) == 0:
+                    break
+                finished.wait()
+
+        self._tasks, self._pending, self._turns = [], {}, deque()
+        return results
@@ -0,0 +1,397 @@
+#!/opt/ioa/software/python/2.7.8/bin/python
+
+""" Serve the status of all WG submissions over HTTP. """
+
+from __future__ import absolute_import, print_function, with_statement
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from xml.sax.saxutils import escape, quoteattr
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urllib import quote, unquote
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import quote, unquote
+
+import checker
+
+
+# Folders that hold collated results rather than node submissions.
+IGNORED_NODES = ("Recommended", "PerSpectra")
+
+
+def published_log_filename(filename):
+    """
+    Return the path of the most recent FITSCHECKER log that is copied next to a
+    submitted file.
+
+    :param filename:
+        The path of the submitted FITS file.
+
+    :type filename:
+        str
+    """
+    return filename[:-5] + "_FITSchecker_REPORT.log"
+
+
+def published_results(inventory):
+    """
+    Read the FITSCHECKER log that has been copied next to each submitted file
+    in a folder inventory.
+
+    :param inventory:
+        The inventory of a folder, as a list of `(filename, created, modified)`
+        tuples.
+
+    :type inventory:
+        list
+
+    :returns:
+        A dictionary of `(num_invalids, num_lines)` tuples keyed by the
+        submitted file, as expected by :func:`classify`. The value is None for
+        files without a log.
+    """
+
+    results = {}
+    for filename, created, modified in inventory:
+        try:
+            with open(published_log_filename(filename), "r") as fp:
+                results[filename] = checker.parse_log(fp.read())
+        except IOError:
+            results[filename] = None
+    return results
+
+
+def classify(results):
+    """
+    Classify a node submission as valid, invalid, or missing. A submission is
+    valid if at least one of the submitted files has a complete FITSCHECKER log
+    with zero INVALID entries.
+
+    :param results:
+        A dictionary of `(num_invalids, num_lines)` tuples, keyed by the
+        submitted file. The value is None for files without a log.
+
+    :type results:
+        dict
+
+    :returns:
+        A two-length tuple: `(True, filename)` for the first valid file,
+        `(False, results)` if files were submitted but none are valid, or
+        `(None, None)` if nothing has been submitted.
+    """
+
+    for filename in sorted(results.keys()):
+        if results[filename] is None:
+            continue
+        num_invalids, num_lines = results[filename]
+        if num_lines >= checker.MINIMUM_LOG_LINES and num_invalids == 0:
+            return (True, filename)
+
+    if len(results) > 0:
+        return (False, results)
+
+    return (None, None)
+
+
+def node_path(release, node):
+    """
+    Return the path of the status page for a node. Pages are stored under this
+    (unquoted) path; use :func:`node_url` to link to them.
+
+    :param release:
+        The name of the data release.
+
+    :type release:
+        str
+
+    :param node:
+        The "WG node" name (see :func:`node_name`).
+
+    :type node:
+        str
+    """
+    return "/status/{0}/{1}.json".format(release, "/".join(node.split(" ", 1)))
+
+
+def node_url(release, node):
+    """
+    Return the URL of the status page for a node, with every path segment
+    quoted so that node names like `??1` can be requested.
+
+    :param release:
+        The name of the data release.
+
+    :type release:
+        str
+
+    :param node:
+        The "WG node" name (see :func:`node_name`).
+
+    :type node:
+        str
+    """
+    return "/".join([quote(segment, safe="") \
+        for segment in node_path(release, node).split("/")])
+
+
+def node_name(folder):
+    """
+    Return the "WG node" name of a watched folder.
+
+    :param folder:
+        The path of the watched folder.
+
+    :type folder:
+        str
+    """
+    return " ".join(folder.rstrip("/").split("/")[-2:])
+
+
+
+class StatusView(object):
+    """
+    An in-memory view of the valid, invalid and missing submissions for every
+    WG and node, which is updated as each folder is reported. The pages that
+    are served are rendered when the view changes, so that serving them is a
+    dictionary lookup.
+    """
+
+    def __init__(self):
+        self._results = {}
+        self._lock = threading.Lock()
+        self._pages = {}
+        self._render()
+
+
+    def load(self, release, full_inventory):
+        """
+        Seed the view for a release from its inventory and the FITSCHECKER logs
+        that have been copied next to each submitted file.
+
+        :param release:
+            The name of the data release.
+
+        :type release:
+            str
+
+        :param full_inventory:
+            A dictionary of folder inventories, keyed by the folder path.
+
+        :type full_inventory:
+            dict
+        """
+
+        nodes = {}
+        for folder, inventory in full_inventory.items():
+            if folder.rstrip("/").split("/")[-1] in IGNORED_NODES:
+                continue
+
+            nodes.setdefault(node_name(folder), {}).update(
+                published_results(inventory))
+
+        with self._lock:
+            self._results[release] = nodes
+            self._render()
+
+
+    def update(self, release, folder, result):
+        """
+        Record the result of running FITSCHECKER on a submitted file.
+
+        :param release:
+            The name of the data release.
+
+        :type release:
+            str
+
+        :param folder:
+            The path of the watched folder that the file is in.
+
+        :type folder:
+            str
+
+        :param result:
+            The outcome of running FITSCHECKER.
+
+        :type result:
+            :class:`checker.CheckResult`
+        """
+
+        if folder.rstrip("/").split("/")[-1] in IGNORED_NODES \
+        or result.status != checker.OK:
+            return
+
+        with self._lock:
+            results = self._results.setdefault(release, {})\
+                .setdefault(node_name(folder), {})
+            results[result.filename] = (result.num_invalids, result.num_lines)
+            self._render()
+
+
+    def _render(self):
+        """
+        Render every page from the current results. This must be called with
+        the lock held (or before the view is shared).
+        """
+
+        status = {}
+        pages = {}
+        for release, nodes in self._results.items():
+            valid, invalid, missing = {}, {}, []
+            for node in sorted(nodes.keys()):
+                result, info = classify(nodes[node])
+                if result is True:
+                    valid[node] = info
+                    state = "valid"
+                elif result is False:
+                    invalid[node] = dict([(filename, None if each is None else \
+                        dict(invalids=each[0], lines=each[1])) \
+                        for filename, each in info.items()])
+                    state = "invalid"
+                else:
+                    missing.append(node)
+                    state = "missing"
+
+                pages[node_path(release, node)] = ("application/json",
+                    json.dumps(dict(release=release, node=node, status=state,
+                        files=invalid.get(node, valid.get(node)))))
+
+            status[release] = dict(valid=valid, invalid=invalid,
+                missing=missing)
+
+        updated = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        pages["/status.json"] = ("application/json",
+            json.dumps(dict(updated=updated, releases=status)))
+
+        html = ["<!DOCTYPE html>", "<html><head><meta charset=\"utf-8\">",
+            "<meta http-equiv=\"refresh\" content=\"60\">",
+            "<title>GES FITSCHECKER status</title></head><body>",
+            "<h1>GES FITSCHECKER status</h1>",
+            "<p>Updated {0}</p>".format(updated)]
+        for release in sorted(status.keys()):
+            html.append("<h2>{0}</h2>".format(escape(release)))
+
+            html.append("<h3>Nodes that have submitted valid results</h3><ul>")
+            for node in sorted(status[release]["valid"].keys()):
+                html.append("<li><a href={0}>{1}</a>: {2}</li>".format(
+                    quoteattr(node_url(release, node)), escape(node),
+                    escape(status[release]["valid"][node])))
+            html.append("</ul>")
+
+            html.append("<h3>Nodes that have submitted results, but they still "
+                "have errors</h3><ul>")
+            for node in sorted(status[release]["invalid"].keys()):
+                html.append("<li><a href={0}>{1}</a><ul>".format(
+                    quoteattr(node_url(release, node)), escape(node)))
+                files = status[release]["invalid"][node]
+                for filename in sorted(files.keys()):
+                    if files[filename] is None:
+                        description = "not checked yet"
+                    else:
+                        description = "{invalids} INVALIDs, {lines} lines"\
+                            .format(**files[filename])
+                    html.append("<li>{0}: {1}</li>".format(escape(filename),
+                        description))
+                html.append("</ul></li>")
+            html.append("</ul>")
+
+            html.append("<h3>Currently missing results from</h3><ul>")
+            for node in status[release]["missing"]:
+                html.append("<li><a href={0}>{1}</a></li>".format(
+                    quoteattr(node_url(release, node)), escape(node)))
+            html.append("</ul>")
+
+        html.append("</body></html>")
+        pages["/"] = ("text/html; charset=utf-8", "\n".join(html))
+
+        # Swap the pages in one assignment, so readers never see a partial set.
+        self._pages = dict([(path, (content_type, body.encode("utf-8") \
+            if not isinstance(body, bytes) else body)) \
+            for path, (content_type, body) in pages.items()])
+
+
+    def page(self, path):
+        """
+        Return the `(content_type, body)` of a page, or None if it does not
+        exist.
+
+        :param path:
+            The path of the page, e.g. `/status.json`.
+
+        :type path:
+            str
+        """
+        return self._pages.get(path)
+
+
+
+class StatusRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serve pages from the :class:`StatusView` attached to the server.
+    """
+
+    def do_GET(self):
+        # Split off the query before unquoting, so that a quoted "?" in a node
+        # name is kept as part of the path.
+        page = self.server.view.page(unquote(self.path.split("?")[0]))
+        if page is None:
+            self.send_error(404)
+            return
+
+        content_type, body = page
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        logging.debug("Status request from {0}: {1}".format(
+            self.address_string(), format % args))
+
+
+
+def serve(view, host="", port=8080):
+    """
+    Serve a status view over HTTP from a background thread.
+
+    :param view:
+        The status view to serve.
+
+    :type view:
+        :class:`StatusView`
+
+    :param host: [optional]
+        The address to listen on (default: all addresses).
+
+    :type host:
+        str
+
+    :param port: [optional]
+        The port to listen on.
+
+    :type port:
+        int
+
+    :returns:
+        The HTTP server, which can be stopped with `shutdown()`.
+    """
+
+    server = HTTPServer((host, port), StatusRequestHandler)
+    server.view = view
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    logging.info("Serving status on {0}:{1}".format(host or "*", port))
+    return server
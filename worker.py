@@ -0,0 +1,157 @@
+#!/opt/ioa/software/python/2.7.8/bin/python
+
+""" Claim FITSCHECKER jobs from a shared work queue and run them. """
+
+from __future__ import absolute_import, print_function, with_statement
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import argparse
+import logging
+import os
+import socket
+import threading
+import time
+
+import run
+import workqueue
+
+
+def work(queue, name, checkers, lease=900, poll=30, max_jobs=None,
+    exit_when_empty=False):
+    """
+    Claim and run jobs from the work queue.
+
+    :param queue:
+        The shared work queue.
+
+    :type queue:
+        :class:`workqueue.WorkQueue`
+
+    :param name:
+        A name that identifies this worker.
+
+    :type name:
+        str
+
+    :param checkers:
+        A dictionary of FITSCHECKER workers, keyed by release name. Only jobs
+        from these releases are claimed.
+
+    :type checkers:
+        dict
+
+    :param lease: [optional]
+        The time (in seconds) that each lease lasts. Leases are renewed while
+        FITSCHECKER is running.
+
+    :type lease:
+        float
+
+    :param poll: [optional]
+        The time (in seconds) to wait before looking for jobs again when the
+        queue is empty.
+
+    :type poll:
+        float
+
+    :param max_jobs: [optional]
+        Stop after running this many jobs.
+
+    :type max_jobs:
+        int
+
+    :param exit_when_empty: [optional]
+        Stop when there are no jobs available, rather than waiting for more.
+
+    :type exit_when_empty:
+        bool
+
+    :returns:
+        The number of jobs run.
+    """
+
+    n_jobs = 0
+    while max_jobs is None or n_jobs < max_jobs:
+
+        job = queue.claim(name, lease=lease, releases=checkers.keys())
+        if job is None:
+            if exit_when_empty:
+                break
+            time.sleep(poll)
+            continue
+
+        if job["release"] not in checkers:
+            logging.warn("Worker {0} has no FITSCHECKER for release {1}; "
+                "releasing job {2}".format(name, job["release"], job["id"]))
+            queue.release(job["id"], name)
+            continue
+
+        logging.info("Worker {0} claimed job {1} for {2}".format(name,
+            job["id"], job["filename"]))
+
+        # Keep renewing the lease while FITSCHECKER is running.
+        done = threading.Event()
+        def heartbeat():
+            while not done.wait(lease / 3.0):
+                if not queue.renew(job["id"], name, lease=lease):
+                    logging.warn("Worker {0} lost the lease on job {1}"\
+                        .format(name, job["id"]))
+                    break
+
+        thread = threading.Thread(target=heartbeat)
+        thread.daemon = True
+        thread.start()
+        try:
+            result = checkers[job["release"]].run(job["filename"])
+        finally:
+            done.set()
+            thread.join()
+
+        if not queue.complete(job["id"], name, result):
+            logging.warn("Worker {0} finished job {1} but it had been given to "
+                "another worker; discarding the result".format(name, job["id"]))
+        n_jobs += 1
+
+    return n_jobs
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Claim FITSCHECKER jobs from "
+        "a shared work queue written by `run.py --queue`, and run them.")
+    parser.add_argument("queue",
+        help="The path of the shared work queue.")
+    parser.add_argument("--release", action="append", dest="releases",
+        help="Only run jobs for this release (default: all releases).")
+    parser.add_argument("--name", default=None,
+        help="A name that identifies this worker (default: host and PID).")
+    parser.add_argument("--lease", type=float, default=run.FITSCHECKER_TIMEOUT,
+        help="The time (in seconds) that each lease on a job lasts.")
+    parser.add_argument("--poll", type=float, default=30,
+        help="The time (in seconds) between looks at an empty queue.")
+    parser.add_argument("--max-jobs", type=int, default=None,
+        help="Stop after running this many jobs.")
+    parser.add_argument("--exit-when-empty", action="store_true",
+        help="Stop when there are no jobs available.")
+    parser.add_argument("--log", default=None,
+        help="The path of the log file (default: worker-<name>.log).")
+    args = parser.parse_args()
+
+    name = args.name or "{0}-{1}".format(socket.gethostname(), os.getpid())
+    logging.basicConfig(level=logging.DEBUG,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        filename=args.log or os.path.join(os.path.dirname(__file__),
+            "worker-{0}.log".format(name)))
+
+    checkers = dict([(release["name"], run.release_checker(release)) \
+        for release in run.RELEASES \
+        if not args.releases or release["name"] in args.releases])
+    if not checkers:
+        parser.error("no releases to run jobs for (known releases: {0})".format(
+            ", ".join([release["name"] for release in run.RELEASES])))
+
+    n_jobs = work(workqueue.WorkQueue(args.queue), name, checkers,
+        lease=args.lease, poll=args.poll, max_jobs=args.max_jobs,
+        exit_when_empty=args.exit_when_empty)
+    logging.info("Worker {0} ran {1} job(s)".format(name, n_jobs))
@@ -0,0 +1,471 @@
+#!/opt/ioa/software/python/2.7.8/bin/python
+
+""" A shared work queue of FITSCHECKER jobs, backed by SQLite. """
+
+from __future__ import absolute_import, print_function, with_statement
+
+__author__ = "Andy Casey <arc@ast.cam.ac.uk>"
+
+import json
+import logging
+import sqlite3
+import time
+from contextlib import contextmanager
+
+import checker
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS batches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    release TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    previous_inventory TEXT NOT NULL,
+    current_inventory TEXT NOT NULL,
+    created REAL NOT NULL,
+    closed REAL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    batch INTEGER NOT NULL REFERENCES batches (id),
+    release TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_batch ON jobs (batch);
+CREATE INDEX IF NOT EXISTS jobs_unfinished ON jobs (finished, lease_expires);
+"""
+
+
+def _encode_result(result):
+    """
+    Serialise a :class:`checker.CheckResult` to JSON.
+    """
+
+    attributes = dict(vars(result))
+    if isinstance(attributes["output"], bytes):
+        attributes["output"] = attributes["output"].decode("utf-8", "replace")
+    return json.dumps(attributes)
+
+
+def _native(value):
+    """
+    Return a decoded JSON string as the native `str` type, so that it can be
+    used with `str` methods as the rest of the watcher does.
+    """
+    if isinstance(value, str) or not hasattr(value, "encode"):
+        return value
+    return value.encode("utf-8")
+
+
+def _decode_result(contents):
+    """
+    Deserialise a :class:`checker.CheckResult` from JSON.
+    """
+    return checker.CheckResult(**dict([(str(key), _native(value)) \
+        for key, value in json.loads(contents).items()]))
+
+
+def _decode_inventory(contents):
+    """
+    Deserialise a folder inventory from JSON, as a list of tuples.
+    """
+    return [(_native(each[0]), ) + tuple(each[1:]) \
+        for each in json.loads(contents)]
+
+
+
+class WorkQueue(object):
+    """
+    A queue of FITSCHECKER jobs that can be shared between hosts.
+
+    The coordinator submits one batch of jobs per folder. Workers claim jobs
+    with a lease that they must renew while FITSCHECKER is running; if a worker
+    dies, its job is given to another worker once the lease expires. When
+    every job in a batch has finished, the coordinator reports the folder.
+
+    :param filename:
+        The path of the SQLite database, which should be on storage that all
+        workers can reach.
+
+    :type filename:
+        str
+
+    :param max_attempts: [optional]
+        The number of times a job can be claimed before it is given up on.
+
+    :type max_attempts:
+        int
+
+    :param timeout: [optional]
+        The time (in seconds) to wait for another process to release its lock
+        on the database.
+
+    :type timeout:
+        float
+    """
+
+    def __init__(self, filename, max_attempts=3, timeout=60):
+
+        self.filename = filename
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+
+        connection = self._connect()
+        try:
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+
+
+    def _connect(self):
+        return sqlite3.connect(self.filename, timeout=self.timeout,
+            isolation_level=None)
+
+
+    @contextmanager
+    def _transaction(self):
+        """
+        A context manager for a cursor inside a transaction that holds the
+        write lock on the database from the start.
+        """
+
+        connection = self._connect()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+            except:
+                cursor.execute("ROLLBACK")
+                raise
+            else:
+                cursor.execute("COMMIT")
+        finally:
+            connection.close()
+
+
+    def submit(self, release, folder, previous_inventory, current_inventory,
+        filenames):
+        """
+        Submit a batch of jobs for the new and modified files in a folder.
+
+        :param release:
+            The name of the data release.
+
+        :type release:
+            str
+
+        :param folder:
+            The path of the watched folder.
+
+        :type folder:
+            str
+
+        :param previous_inventory:
+            The previous inventory of the folder.
+
+        :type previous_inventory:
+            list
+
+        :param current_inventory:
+            The most recent inventory of the folder.
+
+        :type current_inventory:
+            list
+
+        :param filenames:
+            The paths of the files to check, in the order they should be
+            reported.
+
+        :type filenames:
+            list of str
+
+        :returns:
+            The batch identifier.
+        """
+
+        with self._transaction() as cursor:
+            cursor.execute("INSERT INTO batches (release, folder, "
+                "previous_inventory, current_inventory, created) "
+                "VALUES (?, ?, ?, ?, ?)", (release, folder,
+                    json.dumps(previous_inventory),
+                    json.dumps(current_inventory), time.time()))
+            batch = cursor.lastrowid
+            cursor.executemany("INSERT INTO jobs (batch, release, filename, "
+                "position) VALUES (?, ?, ?, ?)", [(batch, release, filename, i) \
+                    for i, filename in enumerate(filenames)])
+
+        logging.info("Queued {0} job(s) in batch {1} for {2}".format(
+            len(filenames), batch, folder))
+        return batch
+
+
+    def open_folders(self, release):
+        """
+        Return the folders in a release that have a batch not yet reported.
+
+        :param release:
+            The name of the data release.
+
+        :type release:
+            str
+        """
+
+        connection = self._connect()
+        try:
+            rows = connection.execute("SELECT DISTINCT folder FROM batches "
+                "WHERE release = ? AND closed IS NULL", (release, )).fetchall()
+        finally:
+            connection.close()
+        return set([row[0] for row in rows])
+
+
+    def claim(self, worker, lease=900, releases=None):
+        """
+        Claim the next job. Jobs are taken from the release with the fewest
+        jobs currently running, so that releases share the workers fairly.
+
+        :param worker:
+            A name that identifies the worker.
+
+        :type worker:
+            str
+
+        :param lease: [optional]
+            The time (in seconds) before the job is given to another worker,
+            unless the lease is renewed.
+
+        :type lease:
+            float
+
+        :param releases: [optional]
+            Only claim jobs from these releases (default: all releases).
+
+        :type releases:
+            list of str
+
+        :returns:
+            A dictionary with the job `id`, `batch`, `release` and `filename`,
+            or None if there are no jobs available.
+        """
+
+        if releases is not None:
+            releases = list(releases)
+            if not releases:
+                return None
+
+        query = "SELECT id, batch, release, filename, attempts FROM jobs "\
+            "WHERE finished IS NULL AND (lease_expires IS NULL "\
+            "OR lease_expires < :now) "
+        if releases:
+            query += "AND release IN ({0}) ".format(", ".join(
+                [":release{0}".format(i) for i in range(len(releases))]))
+        query += "ORDER BY (SELECT COUNT(*) FROM jobs AS running "\
+            "WHERE running.release = jobs.release AND running.finished IS NULL "\
+            "AND running.lease_expires >= :now), id LIMIT 1"
+
+        with self._transaction() as cursor:
+            while True:
+                now = time.time()
+                parameters = { "now": now }
+                for i, release in enumerate(releases or []):
+                    parameters["release{0}".format(i)] = release
+
+                row = cursor.execute(query, parameters).fetchone()
+                if row is None:
+                    return None
+
+                id, batch, release, filename, attempts = row
+                if attempts < self.max_attempts:
+                    break
+
+                # Give up on this job, so that its folder can still be reported.
+                logging.warn("Giving up on job {0} for {1} after {2} attempts"\
+                    .format(id, filename, attempts))
+                result = checker.CheckResult(filename, checker.CRASH,
+                    message="No worker finished FITSCHECKER after {0} "
+                        "attempts".format(attempts))
+                cursor.execute("UPDATE jobs SET result = ?, finished = ? "
+                    "WHERE id = ?", (_encode_result(result), now, id))
+
+            cursor.execute("UPDATE jobs SET worker = ?, lease_expires = ?, "
+                "attempts = attempts + 1 WHERE id = ?",
+                (worker, now + lease, id))
+
+        return dict(id=id, batch=batch, release=release, filename=filename)
+
+
+    def renew(self, job, worker, lease=900):
+        """
+        Renew the lease on a job.
+
+        :param job:
+            The job identifier.
+
+        :type job:
+            int
+
+        :param worker:
+            The name of the worker holding the lease.
+
+        :type worker:
+            str
+
+        :param lease: [optional]
+            The time (in seconds) from now that the lease should expire.
+
+        :type lease:
+            float
+
+        :returns:
+            Whether the worker still holds the lease.
+        """
+
+        with self._transaction() as cursor:
+            cursor.execute("UPDATE jobs SET lease_expires = ? WHERE id = ? "
+                "AND worker = ? AND finished IS NULL",
+                (time.time() + lease, job, worker))
+            return cursor.rowcount > 0
+
+
+    def release(self, job, worker):
+        """
+        Give up the lease on a job without running it, so that another worker
+        can claim it straight away. The claim does not count as an attempt.
+
+        :param job:
+            The job identifier.
+
+        :type job:
+            int
+
+        :param worker:
+            The name of the worker holding the lease.
+
+        :type worker:
+            str
+
+        :returns:
+            Whether the worker still held the lease.
+        """
+
+        with self._transaction() as cursor:
+            cursor.execute("UPDATE jobs SET worker = NULL, "
+                "lease_expires = NULL, attempts = attempts - 1 "
+                "WHERE id = ? AND worker = ? AND finished IS NULL",
+                (job, worker))
+            return cursor.rowcount > 0
+
+
+    def complete(self, job, worker, result):
+        """
+        Record the result of a job.
+
+        :param job:
+            The job identifier.
+
+        :type job:
+            int
+
+        :param worker:
+            The name of the worker holding the lease.
+
+        :type worker:
+            str
+
+        :param result:
+            The outcome of running FITSCHECKER.
+
+        :type result:
+            :class:`checker.CheckResult`
+
+        :returns:
+            Whether the result was recorded. It is not recorded if the job has
+            since been given to another worker.
+        """
+
+        with self._transaction() as cursor:
+            cursor.execute("UPDATE jobs SET result = ?, finished = ? "
+                "WHERE id = ? AND worker = ? AND finished IS NULL",
+                (_encode_result(result), time.time(), job, worker))
+            return cursor.rowcount > 0
+
+
+    def finished_batches(self, release):
+        """
+        Return the batches in a release whose jobs have all finished, but which
+        have not been reported yet.
+
+        :param release:
+            The name of the data release.
+
+        :type release:
+            str
+
+        :returns:
+            A list of dictionaries with the batch `id`, `release`, `folder`,
+            `previous_inventory`, `current_inventory` and the job `results`.
+        """
+
+        connection = self._connect()
+        try:
+            batches = connection.execute("SELECT id, folder, "
+                "previous_inventory, current_inventory FROM batches "
+                "WHERE release = ? AND closed IS NULL AND NOT EXISTS "
+                "(SELECT 1 FROM jobs WHERE jobs.batch = batches.id "
+                "AND jobs.finished IS NULL) ORDER BY id", (release, ))\
+                .fetchall()
+
+            finished = []
+            for id, folder, previous_inventory, current_inventory in batches:
+                results = connection.execute("SELECT result FROM jobs "
+                    "WHERE batch = ? ORDER BY position", (id, )).fetchall()
+                finished.append(dict(id=id, release=release, folder=folder,
+                    previous_inventory=_decode_inventory(previous_inventory),
+                    current_inventory=_decode_inventory(current_inventory),
+                    results=[_decode_result(row[0]) for row in results]))
+
+        finally:
+            connection.close()
+
+        return finished
+
+
+    def close(self, batch):
+        """
+        Mark a batch as reported.
+
+        :param batch:
+            The batch identifier.
+
+        :type batch:
+            int
+
+        :returns:
+            Whether this call closed the batch. False means that it had already
+            been closed.
+        """
+
+        with self._transaction() as cursor:
+            cursor.execute("UPDATE batches SET closed = ? WHERE id = ? "
+                "AND closed IS NULL", (time.time(), batch))
+            return cursor.rowcount > 0
+
+
+    def unfinished(self):
+        """
+        Return the number of jobs that have not finished.
+        """
+
+        connection = self._connect()
+        try:
+            return connection.execute("SELECT COUNT(*) FROM jobs "
+                "WHERE finished IS NULL").fetchone()[0]
+        finally:
+            connection.close()